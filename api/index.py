@@ -4,27 +4,55 @@ import json
 import base64
 import pickle
 import logging
+import asyncio
+import sqlite3
+import tempfile
+import threading
+import time
+import functools
+import zlib
+from array import array
+import uuid
+import weakref
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
 from datetime import datetime
 import pdfplumber
-from fastapi import FastAPI, UploadFile, File, HTTPException, Request, Form
-from fastapi.responses import RedirectResponse, JSONResponse
+from pdfminer.converter import TextConverter
+from pdfminer.layout import LAParams
+from pdfminer.pdfinterp import PDFResourceManager, PDFPageInterpreter
+from pdfminer.pdfpage import PDFPage
+import google_auth_httplib2
+from fastapi import FastAPI, UploadFile, File, HTTPException, Request, Form, BackgroundTasks, Query
+from fastapi.responses import RedirectResponse, JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from google_auth_oauthlib.flow import Flow
 from google.auth.transport.requests import Request as GoogleRequest
+from google.auth.exceptions import RefreshError
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+from googleapiclient.http import MediaIoBaseUpload, build_http
 from dotenv import load_dotenv
 from google.oauth2.credentials import Credentials
 import google.generativeai as genai
 import gspread
 import hashlib
-from pydantic import BaseModel
-from typing import List, Optional
+import random
+import re
+from google.api_core import exceptions as google_exceptions
+from pydantic import BaseModel, ValidationError, field_validator
+from typing import List, Literal, Optional
+try:
+    import numpy as np
+except ImportError:  # Hanya dibutuhkan pre-filter lokal (PREFILTER_METHOD)
+    np = None
 
 # ==============================================================================
 # KONFIGURASI DAN SETUP AWAL
 # ==============================================================================
 os.environ['GOOGLE_APPLICATION_CREDENTIALS_JSON'] = '1'
-logging.getLogger('googleapiclient.discovery_cache').setLevel(logging.ERROR)
 logging.getLogger('googleapiclient.discovery').setLevel(logging.WARNING)
 load_dotenv()
 
@@ -65,10 +93,134 @@ SCOPES = [
 ]
 REDIRECT_URI = f"{BACKEND_URL}/api/auth/callback"
 
-# Global variables untuk menyimpan konfigurasi screening
-job_description_text = ""
-job_position_name = ""
-email_subjects = []
+# Batas konkurensi per tahap pipeline screening (fetch -> extract -> analyze -> persist)
+FETCH_CONCURRENCY = int(os.getenv("FETCH_CONCURRENCY", "8"))
+EXTRACT_CONCURRENCY = int(os.getenv("EXTRACT_CONCURRENCY", str(os.cpu_count() or 1)))
+ANALYZE_CONCURRENCY = int(os.getenv("ANALYZE_CONCURRENCY", "8"))
+
+# Gmail batch API menerima maksimal 100 sub-request per panggilan, tapi di atas 50 sub-request
+# Gmail mulai membalas 429 (rate limit). Batch lampiran dibuat lebih kecil karena setiap
+# respons berisi file PDF utuh (base64). Sub-request yang gagal 429/5xx dikirim ulang dengan
+# backoff maksimal BATCH_MAX_RETRIES kali sebelum dicatat sebagai gagal.
+GMAIL_BATCH_SIZE = min(int(os.getenv("GMAIL_BATCH_SIZE", "50")), 100)
+GMAIL_ATTACHMENT_BATCH_SIZE = min(int(os.getenv("GMAIL_ATTACHMENT_BATCH_SIZE", "25")), 100)
+GMAIL_MESSAGE_FIELDS = 'id,internalDate,payload/parts(partId,filename,body/attachmentId,body/size)'
+GMAIL_LIST_PAGE_SIZE = 500
+BATCH_MAX_RETRIES = int(os.getenv("BATCH_MAX_RETRIES", "4"))
+
+# Baris hasil ditulis ke spreadsheet secara bulk: setiap SHEET_FLUSH_ROWS baris atau
+# SHEET_FLUSH_INTERVAL detik, dan sekali lagi di akhir run
+SHEET_FLUSH_ROWS = int(os.getenv("SHEET_FLUSH_ROWS", "50"))
+SHEET_FLUSH_INTERVAL = float(os.getenv("SHEET_FLUSH_INTERVAL", "10"))
+SHEET_MAX_RETRIES = int(os.getenv("SHEET_MAX_RETRIES", "5"))
+
+# Upload CV ke Drive: file di atas DRIVE_RESUMABLE_THRESHOLD byte memakai resumable upload;
+# permission 'anyone with link' diberikan lewat batch request per DRIVE_PERMISSION_BATCH_SIZE file
+DRIVE_RESUMABLE_THRESHOLD = int(os.getenv("DRIVE_RESUMABLE_THRESHOLD", str(5 * 1024 * 1024)))
+DRIVE_UPLOAD_CHUNK_SIZE = 5 * 1024 * 1024
+DRIVE_PERMISSION_BATCH_SIZE = min(int(os.getenv("DRIVE_PERMISSION_BATCH_SIZE", "50")), 100)
+
+# Ekstraksi PDF CV: dijalankan di process pool dan berhenti saat budget tercapai.
+# analyze_with_gemini hanya memakai 5000 karakter pertama dan create_cv_hash 1000 karakter
+# (tanpa spasi).
+# PDF_EXTRACT_PROCESSES=0 menjalankan ekstraksi di thread (mis. di lingkungan tanpa /dev/shm).
+PDF_CHAR_BUDGET = int(os.getenv("PDF_CHAR_BUDGET", "6000"))
+PDF_PAGE_BUDGET = int(os.getenv("PDF_PAGE_BUDGET", "10"))
+PDF_EXTRACT_TIMEOUT = float(os.getenv("PDF_EXTRACT_TIMEOUT", "30"))
+PDF_EXTRACT_PROCESSES = int(os.getenv("PDF_EXTRACT_PROCESSES", str(os.cpu_count() or 1)))
+# Urutan backend ekstraksi; backend berikutnya dipakai jika hasil backend sebelumnya kosong.
+# CV_Hash tidak bergantung pada backend (spasi dibuang, lihat create_cv_hash); baris lama dengan
+# CV_Hash format pdfplumber tetap dikenali lewat create_legacy_cv_hash.
+PDF_EXTRACT_BACKENDS = [
+    name.strip() for name in os.getenv("PDF_EXTRACT_BACKENDS", "pdfminer,pdfplumber").split(",") if name.strip()
+]
+
+# Model dan versi prompt Gemini; keduanya bagian dari kunci cache hasil analisis.
+# Naikkan ANALYSIS_PROMPT_VERSION setiap kali isi prompt analisis diubah.
+GEMINI_MODEL_NAME = 'gemini-2.5-flash'
+ANALYSIS_PROMPT_VERSION = "2"
+# Kuota Gemini (requests/tokens per menit) dan batas request yang berjalan bersamaan
+GEMINI_RPM = int(os.getenv("GEMINI_RPM", "1000"))
+GEMINI_TPM = int(os.getenv("GEMINI_TPM", "1000000"))
+GEMINI_MAX_IN_FLIGHT = int(os.getenv("GEMINI_MAX_IN_FLIGHT", "8"))
+GEMINI_MAX_RETRIES = int(os.getenv("GEMINI_MAX_RETRIES", "5"))
+GEMINI_OUTPUT_TOKEN_ESTIMATE = 2000
+# Context cache eksplisit hanya dibuat jika prefix (instruksi + deskripsi pekerjaan) memenuhi
+# batas minimum token model; di bawah itu Gemini 2.5 tetap memakai implicit caching.
+GEMINI_CONTEXT_CACHE_MIN_TOKENS = int(os.getenv("GEMINI_CONTEXT_CACHE_MIN_TOKENS", "1024"))
+GEMINI_CONTEXT_CACHE_TTL = int(os.getenv("GEMINI_CONTEXT_CACHE_TTL", "3600"))
+# Mode batch: beberapa resume dikirim dalam satu prompt (deskripsi pekerjaan cukup sekali).
+# GEMINI_BATCH_SIZE=1 menonaktifkan mode batch.
+GEMINI_BATCH_SIZE = int(os.getenv("GEMINI_BATCH_SIZE", "5"))
+GEMINI_BATCH_WAIT = float(os.getenv("GEMINI_BATCH_WAIT", "0.5"))
+ANALYSIS_CACHE_MAX_BYTES = int(os.getenv("ANALYSIS_CACHE_MAX_BYTES", str(50 * 1024 * 1024)))
+
+# Pre-filter lokal sebelum analisis Gemini: PREFILTER_METHOD=tfidf memberi skor setiap resume
+# terhadap deskripsi pekerjaan (cosine similarity TF-IDF, butuh numpy). IDF dihitung dari korpus
+# semua resume posisi itu (tersimpan di state), sehingga skala skor sama antar run.
+# PREFILTER_TOP_K adalah jatah analisis per run: K resume teratas dari resume baru ditambah resume
+# yang tertunda di run sebelumnya; PREFILTER_MIN_SCORE (0-1) adalah skor minimum. 0 berarti batas
+# tersebut tidak dipakai. Resume yang tidak lolos tetap ikut dinilai ulang di run berikutnya.
+# Default nonaktif.
+PREFILTER_METHOD = os.getenv("PREFILTER_METHOD", "").strip().lower()
+PREFILTER_TOP_K = int(os.getenv("PREFILTER_TOP_K", "0"))
+PREFILTER_MIN_SCORE = float(os.getenv("PREFILTER_MIN_SCORE", "0"))
+if PREFILTER_METHOD and (PREFILTER_METHOD != "tfidf" or np is None):
+    print(f"PREFILTER_METHOD={PREFILTER_METHOD} tidak didukung atau numpy belum terpasang, pre-filter dinonaktifkan.")
+    PREFILTER_METHOD = ""
+PREFILTER_TOKEN_PATTERN = re.compile(r"\w{2,}")
+
+# Deteksi CV hampir sama (near-duplicate) per akun dan posisi: shingle NEAR_DUP_SHINGLE_SIZE kata
+# dari teks hasil ekstraksi (dibatasi PDF_CHAR_BUDGET/PDF_PAGE_BUDGET, sehingga dua CV yang sama
+# persis di bagian awal itu dianggap sama), signature MinHash NEAR_DUP_PERMUTATIONS nilai, dan index LSH
+# NEAR_DUP_BANDS band. CV dengan estimasi kemiripan Jaccard >= NEAR_DUP_THRESHOLD terhadap CV
+# yang sudah diproses di posisi yang sama dilewati sebelum upload Drive dan analisis Gemini.
+# NEAR_DUP_THRESHOLD=0 menonaktifkan.
+NEAR_DUP_THRESHOLD = float(os.getenv("NEAR_DUP_THRESHOLD", "0.9"))
+NEAR_DUP_SHINGLE_SIZE = 5
+NEAR_DUP_PERMUTATIONS = 128
+NEAR_DUP_BANDS = 16
+# Konstanta hash universal (a * x + b) mod p; seed tetap agar signature yang tersimpan tetap valid
+NEAR_DUP_PRIME = (1 << 31) - 1
+_near_dup_random = random.Random(20240601)
+NEAR_DUP_HASH_A = [_near_dup_random.randrange(1, NEAR_DUP_PRIME) for _ in range(NEAR_DUP_PERMUTATIONS)]
+NEAR_DUP_HASH_B = [_near_dup_random.randrange(0, NEAR_DUP_PRIME) for _ in range(NEAR_DUP_PERMUTATIONS)]
+
+# State lokal (cursor Gmail, index, cache) disimpan di SQLite. Di Vercel hanya /tmp yang bisa ditulis.
+STATE_DIR = os.getenv("SCREENING_STATE_DIR", os.path.join(tempfile.gettempdir(), "screening-cv"))
+STATE_DB_PATH = os.path.join(STATE_DIR, "state.db")
+# File PDF lampiran yang sedang di antrean kerja disimpan di sini sampai barisnya tertulis
+WORK_BLOB_DIR = os.path.join(STATE_DIR, "blobs")
+# Item antrean yang gagal sebanyak ini tidak dicoba lagi (tetap tercatat dengan last_error)
+WORK_MAX_ATTEMPTS = int(os.getenv("WORK_MAX_ATTEMPTS", "5"))
+
+# Service Gmail/Drive/gspread yang sudah dibangun di-cache per access token selama SERVICE_CACHE_TTL detik
+SERVICE_CACHE_TTL = float(os.getenv("SERVICE_CACHE_TTL", "600"))
+SERVICE_CACHE_MAX_ENTRIES = int(os.getenv("SERVICE_CACHE_MAX_ENTRIES", "256"))
+
+# Job screening background: lama job selesai disimpan di memori dan interval keep-alive SSE (detik)
+SCREENING_JOB_RETENTION = float(os.getenv("SCREENING_JOB_RETENTION", "3600"))
+SSE_KEEPALIVE_INTERVAL = float(os.getenv("SSE_KEEPALIVE_INTERVAL", "15"))
+
+# Ukuran halaman maksimum /api/get-results?limit=...
+RESULTS_MAX_PAGE_SIZE = int(os.getenv("RESULTS_MAX_PAGE_SIZE", "1000"))
+# Mirror hasil yang sudah ada langsung dipakai; modifiedTime spreadsheet dicek di background
+# paling sering sekali per RESULTS_CHECK_INTERVAL detik per spreadsheet
+RESULTS_CHECK_INTERVAL = float(os.getenv("RESULTS_CHECK_INTERVAL", "30"))
+
+# Kolom spreadsheet hasil screening; CV_Hash selalu kolom terakhir
+SHEET_HEADERS = [
+    'Waktu', 'Drive Link', 'Nama', 'Email', 'Nomor Telepon',
+    'Pendidikan Terakhir', 'Kekuatan', 'Kekurangan', 
+    'Risk Factor', 'Reward Factor', 'Overall Fit', 'Justifikasi', 'CV_Hash'
+]
+CV_HASH_COLUMN = gspread.utils.rowcol_to_a1(1, SHEET_HEADERS.index('CV_Hash') + 1).rstrip('1')
+
+# Konfigurasi screening disimpan per akun (lihat SessionStore). SESSION_STORE=sqlite
+# menyimpannya juga di state.db sehingga bertahan saat server restart.
+SESSION_STORE_BACKEND = os.getenv("SESSION_STORE", "memory")
+# Jumlah JobAnalyzer (satu per deskripsi pekerjaan) yang disimpan bersamaan
+JOB_ANALYZER_CACHE_SIZE = int(os.getenv("JOB_ANALYZER_CACHE_SIZE", "16"))
 
 # ==============================================================================
 # PYDANTIC MODELS
@@ -77,10 +229,52 @@ class ScreeningConfig(BaseModel):
     job_position: str
     email_subjects: List[str]
 
+class MultiScreeningConfig(BaseModel):
+    # Kosong = semua posisi yang sudah dikonfigurasi di session
+    job_positions: List[str] = []
+
 class JobDescriptionResponse(BaseModel):
     message: str
     preview: str
 
+class CVAnalysis(BaseModel):
+    """Hasil analisis satu resume dari Gemini; field kosong diisi nilai default."""
+    nama: str = 'Tidak tercantum'
+    email: str = 'Tidak tercantum'
+    nomor_telepon: str = 'Tidak tercantum'
+    pendidikan_terakhir: str = 'Tidak tercantum'
+    kekuatan: str = 'Tidak dapat dianalisis'
+    kekurangan: str = 'Tidak dapat dianalisis'
+    risk_factor: str = 'Tidak dapat dianalisis'
+    reward_factor: str = 'Tidak dapat dianalisis'
+    overall_fit: int = 0
+    justifikasi: str = 'Tidak dapat dianalisis'
+
+    @field_validator('*', mode='before')
+    @classmethod
+    def fill_defaults(cls, value, info):
+        field = cls.model_fields[info.field_name]
+        if (value is None or value == '') and not field.is_required():
+            return field.default
+        # Gemini kadang mengembalikan daftar poin untuk field teks
+        if isinstance(value, list) and field.annotation is str:
+            return "\n".join(str(item) for item in value)
+        return value
+
+    @field_validator('overall_fit', mode='before')
+    @classmethod
+    def coerce_overall_fit(cls, value):
+        # Pastikan overall_fit adalah integer; ambil angka pertama (mis. "85/100" -> 85)
+        if isinstance(value, str):
+            match = re.search(r'\d+', value)
+            return int(match.group()) if match else 0
+        if isinstance(value, float):
+            return round(value)
+        return value
+
+class CVAnalysisBatchItem(CVAnalysis):
+    id: str
+
 # ==============================================================================
 # FUNGSI-FUNGSI HELPER
 # ==============================================================================
@@ -91,25 +285,78 @@ def credentials_to_dict(credentials):
             'token_uri': credentials.token_uri,
             'client_id': credentials.client_id,
             'client_secret': credentials.client_secret,
-            'scopes': credentials.scopes}
+            'scopes': credentials.scopes,
+            'expiry': credentials.expiry.isoformat() if credentials.expiry else None}
+
+def set_auth_cookie(response, creds_dict: dict):
+    """Menyimpan kredensial (termasuk access token terbaru) di cookie auth_token."""
+    response.set_cookie(
+        key="auth_token", 
+        value=json.dumps(creds_dict), 
+        httponly=True,       # Cookie tidak bisa diakses oleh JavaScript
+        secure=True,         # Hanya dikirim melalui HTTPS
+        samesite="Lax",      # Perlindungan CSRF
+        max_age=60*60*24*7   # Cookie berlaku selama 7 hari
+    )
+
+# Access token hasil refresh, per hash refresh token, dipakai bersama oleh semua request
+# (termasuk yang masih membawa cookie lama) sampai kedaluwarsa
+_refreshed_tokens = {}
+_token_refresh_locks = {}
+_token_refresh_guard = threading.Lock()
+
+def apply_refreshed_token(creds: Credentials, key: str) -> bool:
+    """Memakai access token hasil refresh yang lebih baru dari cache, jika ada."""
+    with _token_refresh_guard:
+        cached = _refreshed_tokens.get(key)
+    if cached is None or (creds.expiry is not None and cached[1] <= creds.expiry):
+        return False
+    creds.token, creds.expiry = cached
+    return True
+
+def refresh_credentials(creds: Credentials):
+    """
+    Refresh access token dengan single-flight per akun: request yang bersamaan menunggu
+    satu refresh yang sama lalu memakai token hasilnya dari cache.
+    """
+    key = token_key(creds)
+    with _token_refresh_guard:
+        lock = _token_refresh_locks.setdefault(key, threading.Lock())
+    with lock:
+        if apply_refreshed_token(creds, key) and creds.valid:
+            return
+        creds.refresh(GoogleRequest())
+        with _token_refresh_guard:
+            _refreshed_tokens[key] = (creds.token, creds.expiry)
 
 def get_creds_from_cookie(request: Request) -> Credentials | None:
-    """Membaca dan memvalidasi kredensial dari cookie."""
+    """
+    Membaca dan memvalidasi kredensial dari cookie. Token yang kedaluwarsa (atau cookie lama
+    tanpa expiry) di-refresh sekali per akun; jika token berubah, cookie diperbarui oleh
+    middleware reissue_auth_cookie.
+    """
     token_str = request.cookies.get("auth_token")
     if not token_str:
         return None
     
     try:
         token_dict = json.loads(token_str)
-        creds = Credentials(**token_dict)
+        expiry = token_dict.pop('expiry', None)
+        creds = Credentials(**token_dict, expiry=datetime.fromisoformat(expiry) if expiry else None)
         # Periksa apakah token valid atau bisa di-refresh
-        if creds and creds.valid:
-            return creds
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(GoogleRequest())
-            return creds
+        if creds.refresh_token:
+            apply_refreshed_token(creds, token_key(creds))
+            if creds.expiry is None or not creds.valid:
+                refresh_credentials(creds)
+        elif not creds.valid:
+            return None
+        if creds.token != token_dict.get('token'):
+            request.state.refreshed_auth_token = credentials_to_dict(creds)
+        return creds
+    except (json.JSONDecodeError, TypeError, ValueError):
         return None
-    except (json.JSONDecodeError, TypeError):
+    except RefreshError as e:
+        print(f"Gagal refresh token: {e}")
         return None
 
 def clear_credentials():
@@ -129,15 +376,107 @@ def get_google_services(request: Request):
     if not creds:
         raise HTTPException(status_code=401, detail="User not authenticated")
     
+    return build_google_services(creds)
+
+_service_cache = {}
+_service_cache_lock = threading.Lock()
+
+def build_google_services(creds: Credentials):
+    """
+    Membangun service Gmail, Drive, dan gspread dari objek Credentials.
+    Service di-cache per fingerprint access token (TTL SERVICE_CACHE_TTL) sehingga request
+    berikutnya tidak mengulang parsing discovery document dan pembuatan transport HTTP.
+    """
     # Simpan kembali token yang mungkin sudah di-refresh ke cookie
     refreshed_creds_dict = credentials_to_dict(creds)
     
-    gmail = build('gmail', 'v1', credentials=creds)
-    drive = build('drive', 'v3', credentials=creds)
+    fingerprint = hashlib.sha256(f"{creds.token}\0{creds.refresh_token}".encode()).hexdigest()
+    now = time.monotonic()
+    with _service_cache_lock:
+        cached = _service_cache.get(fingerprint)
+        if cached is not None and cached[0] > now:
+            return (*cached[1], refreshed_creds_dict)
+    
+    # Discovery document statis yang dibundel google-api-python-client; tanpa fetch dan tanpa file cache
+    http = ThreadLocalHttp(creds)
+    gmail = build('gmail', 'v1', http=http, static_discovery=True, cache_discovery=False)
+    drive = build('drive', 'v3', http=http, static_discovery=True, cache_discovery=False)
     gc = gspread.authorize(creds)
     
+    with _service_cache_lock:
+        for key in [key for key, (expires_at, _) in _service_cache.items() if expires_at <= now]:
+            del _service_cache[key]
+        while len(_service_cache) >= SERVICE_CACHE_MAX_ENTRIES:
+            del _service_cache[min(_service_cache, key=lambda key: _service_cache[key][0])]
+        _service_cache[fingerprint] = (now + SERVICE_CACHE_TTL, (gmail, drive, gc))
+    
     return gmail, drive, gc, refreshed_creds_dict
 
+def token_key(creds: Credentials) -> str:
+    """Hash refresh token (atau access token jika tidak ada); token tidak pernah disimpan mentah."""
+    secret = creds.refresh_token or creds.token or ''
+    return hashlib.sha256(secret.encode()).hexdigest()
+
+_account_keys = {}
+_account_keys_lock = threading.Lock()
+
+def account_key(creds: Credentials) -> str:
+    """
+    Identitas akun untuk state lokal per user: hash alamat email Gmail (users.getProfile).
+    Token tidak dipakai sebagai kunci karena berganti setelah logout/login, sehingga state lama
+    (config, cursor, index, file Drive) akan yatim. Pemetaan token -> akun di-cache di memori
+    dan di state.db, jadi getProfile hanya dipanggil sekali per token.
+    """
+    key = token_key(creds)
+    with _account_keys_lock:
+        cached = _account_keys.get(key)
+    if cached is not None:
+        return cached
+    owner = lookup_account_key(key) if creds.refresh_token else None
+    if owner is None:
+        profile = build('gmail', 'v1', http=get_thread_http(creds), static_discovery=True, cache_discovery=False) \
+            .users().getProfile(userId='me', fields='emailAddress').execute()
+        owner = hashlib.sha256(profile['emailAddress'].lower().encode()).hexdigest()
+        if creds.refresh_token:
+            # Access token saja berganti tiap jam; yang disimpan hanya pemetaan refresh token
+            remember_account_key(key, owner)
+    with _account_keys_lock:
+        if len(_account_keys) >= SERVICE_CACHE_MAX_ENTRIES:
+            _account_keys.clear()
+        _account_keys[key] = owner
+    return owner
+
+_thread_local = threading.local()
+
+def get_thread_http(creds: Credentials):
+    """
+    httplib2.Http tidak thread-safe, sehingga setiap thread worker pipeline
+    memakai AuthorizedHttp miliknya sendiri untuk memanggil .execute(http=...).
+    Transport disimpan per thread dan per Credentials sehingga koneksi keep-alive dipakai ulang.
+    build_http() dipakai (bukan httplib2.Http() polos) karena transport itu tidak memperlakukan
+    308 sebagai redirect (dibutuhkan resumable upload Drive) dan memasang socket timeout default.
+    """
+    transports = getattr(_thread_local, 'transports', None)
+    if transports is None:
+        transports = _thread_local.transports = weakref.WeakKeyDictionary()
+    http = transports.get(creds)
+    if http is None:
+        http = transports[creds] = google_auth_httplib2.AuthorizedHttp(creds, http=build_http())
+    return http
+
+class ThreadLocalHttp:
+    """
+    Transport untuk service yang di-cache dan dipakai bersama antar request/thread:
+    setiap panggilan diteruskan ke AuthorizedHttp milik thread yang sedang berjalan.
+    """
+
+    def __init__(self, creds: Credentials):
+        # Dibaca googleapiclient untuk refresh token saat respons 401
+        self.credentials = creds
+
+    def request(self, *args, **kwargs):
+        return get_thread_http(self.credentials).request(*args, **kwargs)
+
 def generate_spreadsheet_name(job_position: str) -> str:
     """Generate nama spreadsheet berdasarkan posisi pekerjaan"""
     if not job_position.strip():
@@ -167,252 +506,3011 @@ def check_auth_status():
         print(f"Error checking auth status: {e}")
         return False
 
-def ensure_spreadsheet_exists(gc, spreadsheet_name: str):
-    """Pastikan spreadsheet ada, jika tidak buat baru"""
-    try:
-        spreadsheet = gc.open(spreadsheet_name)
-        print(f"Spreadsheet '{spreadsheet_name}' ditemukan")
-        return spreadsheet
-    except gspread.exceptions.SpreadsheetNotFound:
-        print(f"Spreadsheet '{spreadsheet_name}' tidak ditemukan, membuat yang baru...")
-        try:
-            # Buat spreadsheet baru
-            spreadsheet = gc.create(spreadsheet_name)
-            sheet = spreadsheet.sheet1
-            
-            # Tambahkan header
-            headers = [
-                'Waktu', 'Drive Link', 'Nama', 'Email', 'Nomor Telepon',
-                'Pendidikan Terakhir', 'Kekuatan', 'Kekurangan', 
-                'Risk Factor', 'Reward Factor', 'Overall Fit', 'Justifikasi', 'CV_Hash'
-            ]
-            sheet.append_row(headers)
-            
-            print(f"Spreadsheet '{spreadsheet_name}' berhasil dibuat!")
-            return spreadsheet
-        except Exception as e:
-            print(f"Error creating spreadsheet: {e}")
-            raise HTTPException(status_code=500, detail=f"Failed to create spreadsheet: {str(e)}")
+def open_spreadsheet(gc, spreadsheet_name: str):
+    """
+    Membuka spreadsheet berdasarkan nama. ID dari registry lokal dipakai dengan open_by_key;
+    pencarian Drive (gc.open) hanya dilakukan jika nama belum terdaftar atau ID lama sudah
+    tidak valid (dihapus, tidak bisa diakses, atau sudah diganti namanya).
+    """
+    owner = account_key(gc.http_client.auth)
+    spreadsheet_id = lookup_spreadsheet_id(owner, spreadsheet_name)
+    if spreadsheet_id:
+        try:
+            spreadsheet = gc.open_by_key(spreadsheet_id)
+            if spreadsheet.title == spreadsheet_name:
+                return spreadsheet
+        except (gspread.exceptions.SpreadsheetNotFound, PermissionError):
+            pass
+        forget_spreadsheet(owner, spreadsheet_name)
+
+    spreadsheet = gc.open(spreadsheet_name)
+    register_spreadsheets(owner, {spreadsheet_name: spreadsheet.id})
+    return spreadsheet
+
+def ensure_spreadsheet_exists(gc, spreadsheet_name: str):
+    """Pastikan spreadsheet ada, jika tidak buat baru"""
+    try:
+        spreadsheet = open_spreadsheet(gc, spreadsheet_name)
+        print(f"Spreadsheet '{spreadsheet_name}' ditemukan")
+        return spreadsheet
+    except gspread.exceptions.SpreadsheetNotFound:
+        print(f"Spreadsheet '{spreadsheet_name}' tidak ditemukan, membuat yang baru...")
+        try:
+            # Buat spreadsheet baru
+            spreadsheet = gc.create(spreadsheet_name)
+            register_spreadsheets(account_key(gc.http_client.auth), {spreadsheet_name: spreadsheet.id})
+            sheet = spreadsheet.sheet1
+            
+            # Tambahkan header
+            sheet.append_row(SHEET_HEADERS)
+            
+            print(f"Spreadsheet '{spreadsheet_name}' berhasil dibuat!")
+            return spreadsheet
+        except Exception as e:
+            print(f"Error creating spreadsheet: {e}")
+            raise HTTPException(status_code=500, detail=f"Failed to create spreadsheet: {str(e)}")
+
+def upload_to_drive(drive, file_data, filename, http=None) -> Optional[str]:
+    """
+    Upload file ke Google Drive dan return ID file (None jika gagal). File besar memakai
+    resumable upload sehingga chunk yang gagal dikirim ulang tanpa mengulang dari awal.
+    Permission file diatur terpisah oleh DriveUploader.
+    """
+    try:
+        # Buat file metadata
+        file_metadata = {
+            'name': f"CV_{filename}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.pdf",
+            'parents': []  # Bisa ditambahkan folder ID jika ingin simpan di folder tertentu
+        }
+        
+        # Upload file
+        media = io.BytesIO(file_data)
+        resumable = len(file_data) > DRIVE_RESUMABLE_THRESHOLD
+        media_upload = MediaIoBaseUpload(
+            media, mimetype='application/pdf', resumable=resumable,
+            chunksize=DRIVE_UPLOAD_CHUNK_SIZE if resumable else -1
+        )
+        
+        file = drive.files().create(
+            body=file_metadata,
+            media_body=media_upload,
+            fields='id'
+        ).execute(http=http, num_retries=3)
+        
+        return file.get('id')
+        
+    except Exception as e:
+        print(f"Error uploading to Drive: {e}")
+        return None
+
+def drive_file_link(file_id: str) -> str:
+    return f"https://drive.google.com/file/d/{file_id}/view"
+
+def iter_page_texts_pdfminer(pdf_bytes: bytes, max_pages: Optional[int] = None):
+    """
+    Backend cepat: interpreter pdfminer + TextConverter, tanpa objek char/tabel pdfplumber.
+    boxes_flow=None melewati pengurutan text box yang mahal, baris dan spasi tetap dipertahankan.
+    """
+    output = io.StringIO()
+    resource_manager = PDFResourceManager()
+    device = TextConverter(resource_manager, output, laparams=LAParams(boxes_flow=None))
+    interpreter = PDFPageInterpreter(resource_manager, device)
+    try:
+        for page in PDFPage.get_pages(io.BytesIO(pdf_bytes), maxpages=max_pages or 0):
+            interpreter.process_page(page)
+            yield output.getvalue().strip()
+            output.seek(0)
+            output.truncate(0)
+    finally:
+        device.close()
+
+def iter_page_texts_pdfplumber(pdf_bytes: bytes, max_pages: Optional[int] = None):
+    """Backend fallback: pdfplumber dengan analisis layout lengkap (juga dasar CV_Hash format lama)."""
+    with pdfplumber.open(io.BytesIO(pdf_bytes)) as pdf:
+        for page in pdf.pages[:max_pages]:
+            page_text = page.extract_text()
+            page.close()
+            yield page_text
+
+PDF_TEXT_BACKENDS = {
+    'pdfminer': iter_page_texts_pdfminer,
+    'pdfplumber': iter_page_texts_pdfplumber,
+}
+
+def extract_pdf_text_with_report(pdf_bytes: bytes, max_chars: Optional[int] = None,
+                                 max_pages: Optional[int] = None, timeout: Optional[float] = None,
+                                 backends: Optional[List[str]] = None) -> dict:
+    """
+    Ekstrak teks PDF halaman per halaman dengan backend di `backends` (default
+    PDF_EXTRACT_BACKENDS) secara berurutan.
+    Berhenti lebih awal jika jumlah karakter mencapai max_chars, jumlah halaman mencapai
+    max_pages, atau waktu melewati timeout. Return dict berisi text, backend yang dipakai,
+    daftar backend yang dicoba, dan elapsed_ms.
+    """
+    started = time.monotonic()
+    deadline = started + timeout if timeout else None
+    report = {'text': "", 'backend': None, 'attempted': [], 'elapsed_ms': 0}
+    for backend in backends or PDF_EXTRACT_BACKENDS:
+        iter_page_texts = PDF_TEXT_BACKENDS.get(backend)
+        if iter_page_texts is None:
+            continue
+        report['attempted'].append(backend)
+        page_texts = []
+        total_chars = 0
+        try:
+            for page_text in iter_page_texts(pdf_bytes, max_pages):
+                if page_text:
+                    page_texts.append(page_text)
+                    total_chars += len(page_text) + 1
+                if max_chars and total_chars >= max_chars:
+                    break
+                if deadline and time.monotonic() > deadline:
+                    print(f"Ekstraksi PDF ({backend}) dihentikan setelah {len(page_texts)} halaman (timeout)")
+                    break
+        except Exception as e:
+            print(f"Gagal mengekstrak PDF dengan {backend}: {e}")
+            page_texts = []
+        text = "\n".join(page_texts).strip()
+        if text:
+            report['text'] = text[:max_chars] if max_chars else text
+            report['backend'] = backend
+            break
+        if deadline and time.monotonic() > deadline:
+            break
+    report['elapsed_ms'] = round((time.monotonic() - started) * 1000, 1)
+    return report
+
+def extract_text_from_pdf_bytes(pdf_bytes: bytes, max_chars: Optional[int] = None,
+                                max_pages: Optional[int] = None, timeout: Optional[float] = None) -> str:
+    return extract_pdf_text_with_report(pdf_bytes, max_chars, max_pages, timeout)['text']
+
+_pdf_pool = None
+_pdf_pool_lock = threading.Lock()
+
+def get_pdf_pool():
+    """Process pool untuk ekstraksi PDF; None jika dinonaktifkan atau tidak didukung host."""
+    global _pdf_pool, PDF_EXTRACT_PROCESSES
+    with _pdf_pool_lock:
+        if _pdf_pool is None and PDF_EXTRACT_PROCESSES > 0:
+            try:
+                _pdf_pool = ProcessPoolExecutor(
+                    max_workers=PDF_EXTRACT_PROCESSES,
+                    mp_context=multiprocessing.get_context("spawn")
+                )
+            except (OSError, NotImplementedError) as e:
+                print(f"Process pool tidak tersedia, ekstraksi PDF memakai thread: {e}")
+                PDF_EXTRACT_PROCESSES = 0
+        return _pdf_pool
+
+def discard_pdf_pool(pool):
+    """Mematikan worker pool (mis. saat ada PDF yang melewati timeout) agar dibuat ulang."""
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is pool:
+            _pdf_pool = None
+    # ProcessPoolExecutor tidak menyediakan API untuk membatalkan task yang sedang berjalan
+    for process in list((getattr(pool, '_processes', None) or {}).values()):
+        process.kill()
+    pool.shutdown(wait=False, cancel_futures=True)
+
+async def extract_pdf_text_async(pdf_bytes: bytes, max_chars: Optional[int] = PDF_CHAR_BUDGET,
+                                 max_pages: Optional[int] = PDF_PAGE_BUDGET,
+                                 backends: Optional[List[str]] = None) -> dict:
+    """
+    Menjalankan extract_pdf_text_with_report di process pool dengan batas waktu per file.
+    PDF yang melewati PDF_EXTRACT_TIMEOUT dianggap gagal (teks kosong) dan worker-nya dimatikan.
+    """
+    failed_report = {'text': "", 'backend': None, 'attempted': [], 'elapsed_ms': PDF_EXTRACT_TIMEOUT * 1000}
+    for attempt in range(2):
+        pool = get_pdf_pool()
+        if pool is None:
+            return await asyncio.to_thread(
+                extract_pdf_text_with_report, pdf_bytes, max_chars, max_pages, PDF_EXTRACT_TIMEOUT, backends
+            )
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(
+            pool, extract_pdf_text_with_report, pdf_bytes, max_chars, max_pages, PDF_EXTRACT_TIMEOUT, backends
+        )
+        try:
+            return await asyncio.wait_for(future, PDF_EXTRACT_TIMEOUT)
+        except asyncio.TimeoutError:
+            print(f"Ekstraksi PDF melewati batas {PDF_EXTRACT_TIMEOUT} detik, dibatalkan")
+            discard_pdf_pool(pool)
+            return failed_report
+        except BrokenProcessPool:
+            # Pool dimatikan karena file lain timeout; coba sekali lagi di pool baru
+            discard_pdf_pool(pool)
+    return failed_report
+
+def add_extraction_stats(extraction_stats: dict, report: dict):
+    """Mengakumulasi jumlah file dan waktu ekstraksi per backend untuk ringkasan screening."""
+    backend = report['backend'] or 'failed'
+    entry = extraction_stats.setdefault(backend, {'files': 0, 'total_ms': 0.0, 'fallbacks': 0})
+    entry['files'] += 1
+    entry['total_ms'] = round(entry['total_ms'] + report['elapsed_ms'], 1)
+    if len(report['attempted']) > 1:
+        entry['fallbacks'] += 1
+
+def build_analysis_system_instruction(job_desc: str) -> str:
+    """Instruksi, format output, kriteria, dan deskripsi pekerjaan: prefix yang sama untuk semua resume."""
+    return f"""
+        Sebagai seorang HR Specialist yang berpengalaman, analisis resume pelamar yang diberikan dengan detail dan objektif berdasarkan deskripsi pekerjaan di bawah ini.
+
+        INSTRUKSI ANALISIS:
+        1. Baca resume dengan teliti dan ekstrak informasi penting
+        2. Bandingkan dengan requirements job description
+        3. Berikan penilaian yang objektif dan konstruktif
+        4. Fokus pada relevansi dan potensi kandidat
+
+        FORMAT OUTPUT (JSON ONLY, NO MARKDOWN):
+        {{
+            "nama": "Nama lengkap pelamar (wajib diisi dari resume)",
+            "email": "Email pelamar jika tersedia, jika tidak ada tulis 'Tidak tercantum'",
+            "nomor_telepon": "Nomor telepon jika tersedia, jika tidak ada tulis 'Tidak tercantum', Gunakan format contoh +6289836718275",
+            "pendidikan_terakhir": "Jenjang dan jurusan pendidikan terakhir (Rubah Seluruhnya Gunakan bahasa indonesia dengan Format contoh: S1 Informatika)",
+            "kekuatan": "3-4 kekuatan utama kandidat yang relevan dengan posisi (maksimal 200 kata)",
+            "kekurangan": "Area yang perlu ditingkatkan atau gap yang ditemukan (maksimal 150 kata)",
+            "risk_factor": "Potensi risiko dalam merekrut kandidat ini (maksimal 150 kata)",
+            "reward_factor": "Potensi manfaat dan value yang akan dibawa kandidat (maksimal 150 kata)",
+            "overall_fit": 85,
+            "justifikasi": "Penjelasan detail mengapa memberikan score tersebut (maksimal 200 kata)"
+        }}
+
+        KRITERIA PENILAIAN:
+        - Overall Fit Score (0-100):
+          * 90-100: Sangat sesuai, kandidat ideal
+          * 80-89: Sesuai dengan sedikit gap
+          * 70-79: Cukup sesuai tapi ada beberapa kekurangan
+          * 60-69: Kurang sesuai, banyak gap
+          * <60: Tidak sesuai
+
+        DESKRIPSI PEKERJAAN:
+        {job_desc[:2000]}
+
+        Berikan analisis yang profesional, jujur, dan membantu dalam proses seleksi.
+        """
+
+def build_resume_prompt(resume_text: str) -> str:
+    return f"""
+        RESUME PELAMAR:
+        {resume_text[:5000]}
+        """
+
+def build_batch_resume_prompt(resumes) -> str:
+    """Prompt untuk beberapa resume sekaligus; `resumes` berupa list (resume_id, resume_text)."""
+    resume_sections = "\n\n".join(
+        f"=== RESUME {resume_id} ===\n{resume_text[:5000]}" for resume_id, resume_text in resumes
+    )
+    return f"""
+        Analisis SETIAP resume berikut secara terpisah dan jangan mencampur informasi antar resume.
+        Untuk permintaan ini, kembalikan JSON ARRAY (NO MARKDOWN) berisi satu objek untuk setiap resume
+        dengan format output yang sama, ditambah field "id" berisi ID resume persis seperti pada judul RESUME.
+
+        DAFTAR RESUME PELAMAR:
+        {resume_sections}
+        """
+
+# Structured output: Gemini diminta mengembalikan JSON sesuai skema field CVAnalysis
+ANALYSIS_RESPONSE_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        name: {'type': 'integer' if name == 'overall_fit' else 'string'}
+        for name in CVAnalysis.model_fields
+    },
+    'required': list(CVAnalysis.model_fields),
+}
+BATCH_ANALYSIS_RESPONSE_SCHEMA = {
+    'type': 'array',
+    'items': {
+        'type': 'object',
+        'properties': {'id': {'type': 'string'}, **ANALYSIS_RESPONSE_SCHEMA['properties']},
+        'required': ['id', *ANALYSIS_RESPONSE_SCHEMA['required']],
+    },
+}
+ANALYSIS_GENERATION_CONFIG = genai.GenerationConfig(
+    response_mime_type="application/json", response_schema=ANALYSIS_RESPONSE_SCHEMA
+)
+BATCH_ANALYSIS_GENERATION_CONFIG = genai.GenerationConfig(
+    response_mime_type="application/json", response_schema=BATCH_ANALYSIS_RESPONSE_SCHEMA
+)
+
+class JobAnalyzer:
+    """
+    Analyzer per posisi yang dibuat sekali saat deskripsi pekerjaan di-upload.
+    Instance GenerativeModel menyimpan instruksi dan deskripsi pekerjaan sebagai system
+    instruction, sehingga setiap panggilan hanya mengirim resume. Prefix yang identik ini
+    dimanfaatkan implicit caching Gemini 2.5; jika prefix cukup panjang untuk context cache
+    eksplisit, cache tersebut dibuat dan dipakai.
+    """
+
+    def __init__(self, job_desc: str):
+        self.job_desc = job_desc
+        self.system_instruction = build_analysis_system_instruction(job_desc)
+        self.base_model = genai.GenerativeModel(GEMINI_MODEL_NAME, system_instruction=self.system_instruction)
+        self.model = self.base_model
+        self.cached_content = None
+        if len(self.system_instruction) // 4 >= GEMINI_CONTEXT_CACHE_MIN_TOKENS:
+            try:
+                self.cached_content = genai.caching.CachedContent.create(
+                    model=f"models/{GEMINI_MODEL_NAME}",
+                    system_instruction=self.system_instruction,
+                    ttl=GEMINI_CONTEXT_CACHE_TTL
+                )
+                self.model = genai.GenerativeModel.from_cached_content(self.cached_content)
+            except Exception as e:
+                print(f"Context cache tidak tersedia, memakai system instruction biasa: {e}")
+
+    def close(self):
+        """Hapus context cache eksplisit (jika ada) saat analyzer diganti."""
+        if self.cached_content is not None:
+            try:
+                self.cached_content.delete()
+            except Exception as e:
+                print(f"Error deleting context cache: {e}")
+            self.cached_content = None
+            self.model = self.base_model
+
+    async def generate(self, prompt: str, generation_config=ANALYSIS_GENERATION_CONFIG):
+        try:
+            return await gemini_scheduler.generate(self.model, prompt, generation_config=generation_config)
+        except (google_exceptions.NotFound, google_exceptions.InvalidArgument,
+                google_exceptions.PermissionDenied):
+            if self.model is self.base_model:
+                raise
+            # Context cache kedaluwarsa atau ditolak; lanjutkan tanpa cache
+            print("Context cache tidak lagi tersedia, memakai model tanpa cache")
+            self.model = self.base_model
+            return await gemini_scheduler.generate(self.model, prompt, generation_config=generation_config)
+
+def clean_json_text(response_text: str) -> str:
+    """Membuang pembungkus markdown ```json dari respons Gemini."""
+    cleaned_text = response_text.strip()
+    if cleaned_text.startswith('```json'):
+        cleaned_text = cleaned_text.replace('```json', '').replace('```', '').strip()
+    elif cleaned_text.startswith('```'):
+        cleaned_text = cleaned_text.replace('```', '').strip()
+    return cleaned_text
+
+def repair_json_candidates(text: str):
+    """
+    Kandidat perbaikan murah untuk JSON yang terpotong: mulai dari kurung pertama,
+    tutup string dan kurung yang masih terbuka, lalu tangani key yang menggantung.
+    """
+    starts = [index for index in (text.find('{'), text.find('[')) if index >= 0]
+    if not starts:
+        return []
+    text = text[min(starts):]
+
+    closers = []
+    in_string = False
+    escaped = False
+    for char in text:
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == '\\':
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char in '{[':
+            closers.append('}' if char == '{' else ']')
+        elif char in '}]' and closers:
+            closers.pop()
+
+    base = (text + '"' if in_string else text).rstrip()
+    closing = ''.join(reversed(closers))
+    return [
+        base.rstrip(',') + closing,
+        base + ' null' + closing,                                  # "key": tanpa nilai
+        re.sub(r',\s*"[^"]*"\s*$', '', base) + closing,            # "key" tanpa titik dua
+    ]
+
+# Objek hasil repair baru diterima jika field ini ada; tanpa itu CV akan tertulis dengan skor 0
+REPAIR_REQUIRED_FIELDS = ('nama', 'overall_fit')
+
+class RepairedAnalysis(dict):
+    """Hasil analisis dari JSON terpotong yang diperbaiki: dipakai di run ini, tetapi tidak di-cache."""
+
+def load_json_with_repair(response_text: str):
+    """
+    json.loads dengan satu putaran perbaikan murah sebelum dianggap gagal.
+    Return (data, repaired) dengan repaired=True jika JSON harus diperbaiki dulu.
+    """
+    cleaned_text = clean_json_text(response_text)
+    try:
+        return json.loads(cleaned_text), False
+    except json.JSONDecodeError as e:
+        error = e
+    for candidate in repair_json_candidates(cleaned_text):
+        try:
+            data = json.loads(candidate)
+        except json.JSONDecodeError:
+            continue
+        print("Respons JSON Gemini tidak lengkap, berhasil diperbaiki")
+        return data, True
+    raise error
+
+def is_complete_repair(item) -> bool:
+    """Objek hasil repair tetap memuat REPAIR_REQUIRED_FIELDS (tidak terpotong sebelum field tersebut)."""
+    return isinstance(item, dict) and all(item.get(field) not in (None, '') for field in REPAIR_REQUIRED_FIELDS)
+
+def parse_analysis_response(response_text: str) -> dict:
+    """
+    Validasi respons Gemini dengan CVAnalysis; respons rusak/terpotong melewati repair pass.
+    Hasil repair tanpa nama/overall_fit dianggap gagal parse (ValueError).
+    """
+    try:
+        return CVAnalysis.model_validate_json(response_text).model_dump()
+    except ValidationError:
+        pass
+    data, repaired = load_json_with_repair(response_text)
+    if isinstance(data, list) and data:
+        data = data[0]
+    if not repaired:
+        return CVAnalysis.model_validate(data).model_dump()
+    if not is_complete_repair(data):
+        raise ValueError("Respons JSON terpotong sebelum nama/overall_fit")
+    return RepairedAnalysis(CVAnalysis.model_validate(data).model_dump())
+
+def parse_batch_analysis_response(response_text: str) -> dict:
+    """
+    Parse respons JSON array dari prompt batch menjadi dict resume_id -> hasil analisis.
+    Repair hanya menyentuh item terakhir; item itu dilewati (dianalisis ulang sendiri oleh
+    pemanggil) jika nama/overall_fit-nya ikut terpotong.
+    """
+    items, repaired = load_json_with_repair(response_text)
+    if not isinstance(items, list):
+        raise ValueError("Respons batch bukan JSON array")
+    results = {}
+    for index, item in enumerate(items):
+        item_repaired = repaired and index == len(items) - 1
+        if item_repaired and not is_complete_repair(item):
+            print("Item batch terakhir terpotong sebelum nama/overall_fit, dianalisis ulang sendiri")
+            continue
+        try:
+            analysis = CVAnalysisBatchItem.model_validate(item)
+        except ValidationError as e:
+            print(f"Item batch tidak valid, dilewati: {e}")
+            continue
+        result = analysis.model_dump(exclude={'id'})
+        results[analysis.id] = RepairedAnalysis(result) if item_repaired else result
+    return results
+
+_job_analyzers = {}
+_job_analyzers_lock = threading.Lock()
+
+def get_job_analyzer(job_desc: str) -> JobAnalyzer:
+    """
+    Analyzer per deskripsi pekerjaan, dipakai bersama oleh semua user dan run dengan deskripsi
+    yang sama. Analyzer yang paling lama tidak dipakai ditutup jika melewati JOB_ANALYZER_CACHE_SIZE.
+    """
+    key = hashlib.sha256(job_desc.encode()).hexdigest()
+    with _job_analyzers_lock:
+        analyzer = _job_analyzers.pop(key, None)
+        if analyzer is None:
+            analyzer = JobAnalyzer(job_desc)
+        _job_analyzers[key] = analyzer
+        while len(_job_analyzers) > JOB_ANALYZER_CACHE_SIZE:
+            _job_analyzers.pop(next(iter(_job_analyzers))).close()
+    return analyzer
+
+async def request_analysis(analyzer: JobAnalyzer, resume_text: str) -> Optional[dict]:
+    """Satu panggilan Gemini untuk satu resume (tanpa cache)."""
+    response = None
+    try:
+        response = await analyzer.generate(build_resume_prompt(resume_text))
+        return parse_analysis_response(response.text)
+        
+    except (json.JSONDecodeError, ValidationError, ValueError) as e:
+        print(f"JSON parsing error: {e}")
+        print(f"Raw response: {response.text if response is not None else 'No response'}")
+        return None
+    except Exception as e:
+        print(f"Error dari Gemini API: {e}")
+        return None
+
+class AnalysisBatcher:
+    """
+    Mengumpulkan resume dari beberapa coroutine pipeline lalu mengirimnya dalam satu
+    prompt batch (maks. batch_size resume, atau setelah menunggu max_wait detik).
+    Resume yang tidak ada atau gagal di-parse pada respons batch dianalisis ulang satu per satu.
+    """
+
+    def __init__(self, analyzer: JobAnalyzer, batch_size: int = GEMINI_BATCH_SIZE, max_wait: float = GEMINI_BATCH_WAIT):
+        self.analyzer = analyzer
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.pending = []
+        self.flush_handle = None
+        self.tasks = set()
+
+    async def submit(self, resume_text: str) -> Optional[dict]:
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((resume_text, future))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+        elif self.flush_handle is None:
+            self.flush_handle = asyncio.get_running_loop().call_later(self.max_wait, self.flush)
+        return await future
+
+    def flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        items, self.pending = self.pending, []
+        if items:
+            task = asyncio.ensure_future(self._run_batch(items))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def _run_batch(self, items):
+        try:
+            if len(items) == 1:
+                resume_text, future = items[0]
+                future.set_result(await request_analysis(self.analyzer, resume_text))
+                return
+
+            resumes = [(f"cv_{index + 1}", resume_text) for index, (resume_text, _) in enumerate(items)]
+            parsed = {}
+            try:
+                response = await self.analyzer.generate(
+                    build_batch_resume_prompt(resumes), BATCH_ANALYSIS_GENERATION_CONFIG
+                )
+                parsed = parse_batch_analysis_response(response.text)
+            except Exception as e:
+                print(f"Gagal analisis batch ({len(items)} resume), fallback per resume: {e}")
+
+            async def resolve(resume_id, resume_text, future):
+                result = parsed.get(resume_id)
+                if result is None:
+                    result = await request_analysis(self.analyzer, resume_text)
+                future.set_result(result)
+
+            await asyncio.gather(*(
+                resolve(resume_id, resume_text, future)
+                for (resume_id, resume_text), (_, future) in zip(resumes, items)
+            ))
+        finally:
+            for _, future in items:
+                if not future.done():
+                    future.set_result(None)
+
+async def analyze_with_gemini(analyzer: JobAnalyzer, resume_text: str,
+                              batcher: Optional[AnalysisBatcher] = None) -> Optional[dict]:
+    # Resume yang sama untuk deskripsi pekerjaan yang sama tidak perlu dianalisis ulang
+    cache_key = analysis_cache_key(analyzer.job_desc, resume_text)
+    try:
+        cached_result = await asyncio.to_thread(get_cached_analysis, cache_key)
+        if cached_result is not None:
+            print("Hasil analisis diambil dari cache")
+            return cached_result
+    except Exception as e:
+        print(f"Error reading analysis cache: {e}")
+
+    if batcher is not None:
+        result = await batcher.submit(resume_text)
+    else:
+        result = await request_analysis(analyzer, resume_text)
+
+    # Hasil JSON yang diperbaiki tidak di-cache agar run berikutnya meminta analisis utuh
+    if result is not None and not isinstance(result, RepairedAnalysis):
+        try:
+            await asyncio.to_thread(store_cached_analysis, cache_key, result)
+        except Exception as e:
+            print(f"Error writing analysis cache: {e}")
+    return result
+
+# Prefix CV_Hash format baru; hash tanpa prefix berasal dari create_legacy_cv_hash
+CV_HASH_PREFIX = 'v2-'
+
+def create_cv_hash(filename, resume_text):
+    """
+    Membuat hash unik berdasarkan filename dan isi CV untuk deteksi duplikasi.
+    Semua spasi dibuang dulu sehingga hash sama untuk teks pdfminer maupun pdfplumber.
+    """
+    compact_text = "".join(resume_text.split())
+    content = f"{filename}:{compact_text[:1000]}"  # Gunakan 1000 karakter pertama
+    return CV_HASH_PREFIX + hashlib.md5(content.encode()).hexdigest()
+
+def create_legacy_cv_hash(filename, resume_text):
+    """CV_Hash format lama (teks pdfplumber apa adanya), hanya untuk mencocokkan baris lama."""
+    content = f"{filename}:{resume_text[:1000]}"
+    return hashlib.md5(content.encode()).hexdigest()
+
+def has_legacy_cv_hashes(existing_hashes: set) -> bool:
+    """Spreadsheet masih berisi baris dengan CV_Hash format lama."""
+    return any(not cv_hash.startswith(CV_HASH_PREFIX) for cv_hash in existing_hashes)
+
+def get_existing_hashes(sheet):
+    """
+    Mengambil semua hash CV yang sudah ada di spreadsheet.
+    Hanya kolom CV_Hash yang dibaca, dan hanya baris baru sejak sinkronisasi terakhir
+    (lihat sync_sheet_hashes); index lengkapnya disimpan di state lokal.
+    """
+    try:
+        return sync_sheet_hashes(sheet)
+    except Exception as e:
+        print(f"Error getting existing hashes: {e}")
+        return set()
+
+def ensure_headers_exist(sheet):
+    """Memastikan header kolom termasuk CV_Hash ada di spreadsheet"""
+    try:
+        headers = sheet.row_values(1)
+        required_headers = SHEET_HEADERS
+        
+        if not headers or len(headers) != len(required_headers):
+            sheet.clear()
+            sheet.append_row(required_headers)
+            print("Headers updated with new columns")
+            
+    except Exception as e:
+        print(f"Error ensuring headers: {e}")
+
+def build_gmail_query(email_subjects: List[str]) -> str:
+    """Membangun query Gmail berdasarkan subjek email yang diinput"""
+    if not email_subjects:
+        # Default query jika tidak ada subjek yang dispecified
+        return 'subject:cv OR subject:resume has:attachment filename:pdf'
+    
+    # Bangun query dengan OR untuk setiap subjek
+    subject_queries = []
+    for subject in email_subjects:
+        subject = subject.strip()
+        if subject:
+            # Escape special characters jika perlu
+            subject_queries.append(f'subject:{subject}')
+    
+    if not subject_queries:
+        return 'subject:cv OR subject:resume has:attachment filename:pdf'
+    
+    # Gabungkan semua subjek dengan OR dan tambahkan filter attachment
+    query = ' OR '.join(subject_queries) + ' has:attachment filename:pdf'
+    return query
+
+def check_spreadsheet_exists(gc, spreadsheet_name: str) -> bool:
+    """Periksa apakah spreadsheet dengan nama tertentu sudah ada"""
+    try:
+        open_spreadsheet(gc, spreadsheet_name)
+        return True
+    except gspread.exceptions.SpreadsheetNotFound:
+        return False
+
+def get_spreadsheet_url(gc, spreadsheet_name: str) -> str:
+    """Mendapatkan URL spreadsheet berdasarkan nama (dari registry jika sudah terdaftar)"""
+    try:
+        spreadsheet_id = lookup_spreadsheet_id(account_key(gc.http_client.auth), spreadsheet_name)
+        if not spreadsheet_id:
+            spreadsheet_id = open_spreadsheet(gc, spreadsheet_name).id
+        return f"https://docs.google.com/spreadsheets/d/{spreadsheet_id}/edit"
+    except gspread.exceptions.SpreadsheetNotFound:
+        return ""
+# ==============================================================================
+# STATE LOKAL (SQLITE)
+# ==============================================================================
+STATE_DB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS gmail_cursors (
+    account_key TEXT NOT NULL,
+    spreadsheet_name TEXT NOT NULL,
+    gmail_query TEXT NOT NULL,
+    internal_date INTEGER NOT NULL,
+    updated_at TEXT NOT NULL,
+    PRIMARY KEY (account_key, spreadsheet_name, gmail_query)
+);
+CREATE TABLE IF NOT EXISTS attachment_index (
+    account_key TEXT NOT NULL,
+    spreadsheet_name TEXT NOT NULL,
+    message_id TEXT NOT NULL,
+    part_id TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    content_hash TEXT,
+    processed_at TEXT NOT NULL,
+    PRIMARY KEY (account_key, spreadsheet_name, message_id, part_id, size)
+);
+CREATE TABLE IF NOT EXISTS analysis_cache (
+    cache_key TEXT PRIMARY KEY,
+    result TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    last_access REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS analysis_cache_last_access ON analysis_cache (last_access);
+CREATE TABLE IF NOT EXISTS sheet_hashes (
+    spreadsheet_id TEXT NOT NULL,
+    row_number INTEGER NOT NULL,
+    cv_hash TEXT NOT NULL,
+    PRIMARY KEY (spreadsheet_id, row_number)
+);
+CREATE TABLE IF NOT EXISTS sheet_hash_sync (
+    spreadsheet_id TEXT PRIMARY KEY,
+    synced_rows INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS content_index (
+    account_key TEXT NOT NULL,
+    spreadsheet_name TEXT NOT NULL,
+    content_hash TEXT NOT NULL,
+    processed_at TEXT NOT NULL,
+    PRIMARY KEY (account_key, spreadsheet_name, content_hash)
+);
+CREATE TABLE IF NOT EXISTS near_dup_signatures (
+    account_key TEXT NOT NULL,
+    spreadsheet_name TEXT NOT NULL,
+    content_hash TEXT NOT NULL,
+    claimed_by TEXT NOT NULL,
+    signature BLOB NOT NULL,
+    created_at TEXT NOT NULL,
+    PRIMARY KEY (account_key, spreadsheet_name, content_hash)
+);
+CREATE TABLE IF NOT EXISTS near_dup_buckets (
+    account_key TEXT NOT NULL,
+    spreadsheet_name TEXT NOT NULL,
+    bucket INTEGER NOT NULL,
+    content_hash TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS near_dup_buckets_lookup ON near_dup_buckets (account_key, spreadsheet_name, bucket);
+CREATE TABLE IF NOT EXISTS work_items (
+    account_key TEXT NOT NULL,
+    spreadsheet_name TEXT NOT NULL,
+    message_id TEXT NOT NULL,
+    part_id TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    part TEXT NOT NULL,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    content_hash TEXT,
+    resume_text TEXT,
+    cv_hash TEXT,
+    drive_link TEXT,
+    analysis TEXT,
+    updated_at TEXT NOT NULL,
+    PRIMARY KEY (account_key, spreadsheet_name, message_id, part_id, size)
+);
+CREATE INDEX IF NOT EXISTS work_items_state ON work_items (account_key, spreadsheet_name, state);
+CREATE TABLE IF NOT EXISTS drive_files (
+    account_key TEXT NOT NULL,
+    content_hash TEXT NOT NULL,
+    file_id TEXT NOT NULL,
+    shared INTEGER NOT NULL DEFAULT 0,
+    created_at TEXT NOT NULL,
+    PRIMARY KEY (account_key, content_hash)
+);
+CREATE TABLE IF NOT EXISTS screening_sessions (
+    account_key TEXT PRIMARY KEY,
+    data TEXT NOT NULL,
+    updated_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS result_rows (
+    spreadsheet_id TEXT NOT NULL,
+    row_number INTEGER NOT NULL,
+    waktu TEXT,
+    overall_fit INTEGER,
+    data TEXT NOT NULL,
+    PRIMARY KEY (spreadsheet_id, row_number)
+);
+CREATE INDEX IF NOT EXISTS result_rows_overall_fit ON result_rows (spreadsheet_id, COALESCE(overall_fit, -1), row_number);
+CREATE INDEX IF NOT EXISTS result_rows_waktu ON result_rows (spreadsheet_id, waktu, row_number);
+CREATE TABLE IF NOT EXISTS spreadsheet_registry (
+    account_key TEXT NOT NULL,
+    spreadsheet_name TEXT NOT NULL,
+    spreadsheet_id TEXT NOT NULL,
+    updated_at TEXT NOT NULL,
+    PRIMARY KEY (account_key, spreadsheet_name)
+);
+CREATE TABLE IF NOT EXISTS result_sync (
+    spreadsheet_id TEXT PRIMARY KEY,
+    modified_time TEXT,
+    synced_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS prefilter_documents (
+    account_key TEXT NOT NULL,
+    spreadsheet_name TEXT NOT NULL,
+    content_hash TEXT NOT NULL,
+    PRIMARY KEY (account_key, spreadsheet_name, content_hash)
+);
+CREATE TABLE IF NOT EXISTS prefilter_terms (
+    account_key TEXT NOT NULL,
+    spreadsheet_name TEXT NOT NULL,
+    term TEXT NOT NULL,
+    document_frequency INTEGER NOT NULL,
+    PRIMARY KEY (account_key, spreadsheet_name, term)
+);
+CREATE TABLE IF NOT EXISTS account_tokens (
+    token_key TEXT PRIMARY KEY,
+    account_key TEXT NOT NULL,
+    updated_at TEXT NOT NULL
+);
+"""
+
+# Tabel state per posisi yang dikunci per akun (account_key). Versi lama tabel ini tidak punya
+# kolom account_key sehingga isinya tidak bisa dikaitkan ke akun mana pun; tabel tersebut
+# dibuang saat koneksi dibuka dan dibangun ulang oleh run berikutnya.
+ACCOUNT_SCOPED_TABLES = [
+    'gmail_cursors', 'attachment_index', 'content_index', 'near_dup_signatures', 'near_dup_buckets', 'work_items',
+    'prefilter_documents', 'prefilter_terms'
+]
+
+_state_db_lock = threading.RLock()
+_state_db_conn = None
+
+def drop_unscoped_tables(conn):
+    for table in ACCOUNT_SCOPED_TABLES:
+        columns = [row[1] for row in conn.execute(f"PRAGMA table_info({table})").fetchall()]
+        if columns and 'account_key' not in columns:
+            print(f"Tabel state {table} belum dikunci per akun, dibuat ulang.")
+            conn.execute(f"DROP TABLE {table}")
+
+@contextmanager
+def state_db():
+    """Koneksi SQLite bersama untuk state lokal. Akses diserialisasi dengan lock dan di-commit otomatis."""
+    global _state_db_conn
+    with _state_db_lock:
+        if _state_db_conn is None:
+            os.makedirs(STATE_DIR, exist_ok=True)
+            conn = sqlite3.connect(STATE_DB_PATH, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            with conn:
+                drop_unscoped_tables(conn)
+            conn.executescript(STATE_DB_SCHEMA)
+            _state_db_conn = conn
+        with _state_db_conn:
+            yield _state_db_conn
+
+def lookup_account_key(token: str) -> Optional[str]:
+    """account_key yang sudah tercatat untuk hash refresh token, None jika belum pernah di-resolve."""
+    with state_db() as conn:
+        row = conn.execute("SELECT account_key FROM account_tokens WHERE token_key = ?", (token,)).fetchone()
+    return row[0] if row else None
+
+def remember_account_key(token: str, owner: str):
+    """
+    Mencatat pemetaan hash refresh token -> account_key. State yang dulu dikunci dengan hash
+    refresh token itu sendiri (sebelum account_key berbasis email) dipindahkan ke akunnya.
+    """
+    with state_db() as conn:
+        for table in ACCOUNT_SCOPED_TABLES + ['drive_files', 'screening_sessions', 'spreadsheet_registry']:
+            conn.execute(f"UPDATE OR IGNORE {table} SET account_key = ? WHERE account_key = ?", (owner, token))
+            conn.execute(f"DELETE FROM {table} WHERE account_key = ?", (token,))
+        conn.execute(
+            "INSERT OR REPLACE INTO account_tokens VALUES (?, ?, ?)", (token, owner, datetime.now().isoformat())
+        )
+
+def load_gmail_cursor(owner: str, spreadsheet_name: str, gmail_query: str) -> int:
+    """
+    Mengambil internalDate (ms) email terbaru yang sudah selesai diproses, 0 jika belum ada.
+    Cursor disimpan per akun, per posisi, dan per query, sehingga perubahan subjek memulai scan penuh.
+    """
+    with state_db() as conn:
+        row = conn.execute(
+            "SELECT internal_date FROM gmail_cursors WHERE account_key = ? AND spreadsheet_name = ? AND gmail_query = ?",
+            (owner, spreadsheet_name, gmail_query)
+        ).fetchone()
+    return row[0] if row else 0
+
+def save_gmail_cursor(owner: str, spreadsheet_name: str, gmail_query: str, internal_date: int):
+    """Memajukan cursor; cursor tidak pernah dimundurkan."""
+    with state_db() as conn:
+        conn.execute(
+            """
+            INSERT INTO gmail_cursors (account_key, spreadsheet_name, gmail_query, internal_date, updated_at)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(account_key, spreadsheet_name, gmail_query) DO UPDATE SET
+                internal_date = MAX(internal_date, excluded.internal_date),
+                updated_at = excluded.updated_at
+            """,
+            (owner, spreadsheet_name, gmail_query, internal_date, datetime.now().isoformat())
+        )
+
+def clear_gmail_cursors(owner: str, spreadsheet_name: str):
+    """Reset cursor sebuah spreadsheet agar run berikutnya memindai ulang mailbox."""
+    with state_db() as conn:
+        conn.execute(
+            "DELETE FROM gmail_cursors WHERE account_key = ? AND spreadsheet_name = ?", (owner, spreadsheet_name)
+        )
+
+def attachment_index_key(message_id: str, part: dict):
+    """
+    Kunci index lampiran: (message_id, partId, size). attachmentId dari Gmail tidak stabil
+    antar panggilan messages.get, sehingga partId yang dipakai sebagai identitas lampiran.
+    """
+    return message_id, part.get('partId', ''), int(part.get('body', {}).get('size', 0))
+
+def filter_indexed_attachments(owner: str, spreadsheet_name: str, pdf_parts):
+    """Membuang lampiran yang sudah pernah diproses untuk spreadsheet ini, sebelum diunduh."""
+    if not pdf_parts:
+        return [], 0
+    with state_db() as conn:
+        indexed = set(conn.execute(
+            "SELECT message_id, part_id, size FROM attachment_index WHERE account_key = ? AND spreadsheet_name = ?",
+            (owner, spreadsheet_name)
+        ).fetchall())
+    new_parts = [
+        (message_id, part) for message_id, part in pdf_parts
+        if attachment_index_key(message_id, part) not in indexed
+    ]
+    return new_parts, len(pdf_parts) - len(new_parts)
+
+def is_content_indexed(owner: str, spreadsheet_name: str, content_hash: str) -> bool:
+    """Tier kedua: cek hash isi PDF mentah, untuk file yang sama di email/lampiran berbeda."""
+    with state_db() as conn:
+        row = conn.execute(
+            "SELECT 1 FROM content_index WHERE account_key = ? AND spreadsheet_name = ? AND content_hash = ?",
+            (owner, spreadsheet_name, content_hash)
+        ).fetchone()
+    return row is not None
+
+def mark_attachment_processed(owner: str, spreadsheet_name: str, message_id: str, part: dict, content_hash: str):
+    """Mencatat lampiran dan hash isinya sebagai sudah diproses."""
+    now = datetime.now().isoformat()
+    with state_db() as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO attachment_index VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (owner, spreadsheet_name, *attachment_index_key(message_id, part), content_hash, now)
+        )
+        conn.execute(
+            "INSERT OR REPLACE INTO content_index VALUES (?, ?, ?, ?)",
+            (owner, spreadsheet_name, content_hash, now)
+        )
+
+def clear_attachment_index(owner: str, spreadsheet_name: str):
+    """Menghapus index lampiran dan hash isi PDF milik sebuah spreadsheet."""
+    with state_db() as conn:
+        for table in ('attachment_index', 'content_index'):
+            conn.execute(
+                f"DELETE FROM {table} WHERE account_key = ? AND spreadsheet_name = ?", (owner, spreadsheet_name)
+            )
+
+def minhash_signature(resume_text: str) -> Optional[tuple]:
+    """Signature MinHash dari shingle kata teks resume; None jika teks tidak berisi kata."""
+    words = re.findall(r"\w+", resume_text.lower())
+    if not words:
+        return None
+    size = min(NEAR_DUP_SHINGLE_SIZE, len(words))
+    shingles = {
+        zlib.crc32(" ".join(words[i:i + size]).encode()) % NEAR_DUP_PRIME
+        for i in range(len(words) - size + 1)
+    }
+    if np is not None:
+        values = np.fromiter(shingles, dtype=np.uint64, count=len(shingles))
+        hashed = (np.array(NEAR_DUP_HASH_A, dtype=np.uint64)[:, None] * values
+                  + np.array(NEAR_DUP_HASH_B, dtype=np.uint64)[:, None]) % NEAR_DUP_PRIME
+        return tuple(hashed.min(axis=1).tolist())
+    return tuple(
+        min((a * value + b) % NEAR_DUP_PRIME for value in shingles)
+        for a, b in zip(NEAR_DUP_HASH_A, NEAR_DUP_HASH_B)
+    )
+
+def lsh_buckets(signature: tuple) -> List[int]:
+    """Satu kunci bucket per band LSH; nomor band ikut di-hash sehingga bucket antar band tidak bercampur."""
+    rows = len(signature) // NEAR_DUP_BANDS
+    return [
+        int.from_bytes(hashlib.blake2b(
+            array('I', (band,) + signature[band * rows:(band + 1) * rows]).tobytes(), digest_size=8
+        ).digest(), 'big', signed=True)
+        for band in range(NEAR_DUP_BANDS)
+    ]
+
+def claim_near_duplicate(owner: str, spreadsheet_name: str, item: dict, resume_text: str) -> Optional[str]:
+    """
+    Cari CV yang hampir sama di index posisi ini lewat bucket LSH (hanya kandidat yang berbagi
+    bucket yang dibandingkan). Return content_hash CV tersebut, atau None setelah CV ini
+    didaftarkan ke index sehingga coroutine lain yang memproses CV serupa ikut terdeteksi.
+    PDF dengan isi sama yang sudah didaftarkan lampiran lain juga dianggap duplikat; pendaftaran
+    milik lampiran ini sendiri (run sebelumnya yang terputus) tidak.
+    """
+    if NEAR_DUP_THRESHOLD <= 0:
+        return None
+    signature = minhash_signature(resume_text)
+    if signature is None:
+        return None
+    content_hash = item['content_hash']
+    claimant = json.dumps(attachment_index_key(item['message_id'], item['part']))
+    buckets = lsh_buckets(signature)
+    with state_db() as conn:
+        candidates = conn.execute(
+            "SELECT DISTINCT s.content_hash, s.signature FROM near_dup_buckets b "
+            "JOIN near_dup_signatures s ON s.account_key = b.account_key "
+            "AND s.spreadsheet_name = b.spreadsheet_name AND s.content_hash = b.content_hash "
+            f"WHERE b.account_key = ? AND b.spreadsheet_name = ? AND b.bucket IN ({', '.join('?' * len(buckets))}) "
+            "AND b.content_hash != ?",
+            (owner, spreadsheet_name, *buckets, content_hash)
+        ).fetchall()
+        for other_hash, other_blob in candidates:
+            other = array('I')
+            other.frombytes(other_blob)
+            similarity = sum(a == b for a, b in zip(signature, other)) / len(signature)
+            if similarity >= NEAR_DUP_THRESHOLD:
+                return other_hash
+        inserted = conn.execute(
+            "INSERT OR IGNORE INTO near_dup_signatures VALUES (?, ?, ?, ?, ?, ?)",
+            (owner, spreadsheet_name, content_hash, claimant, array('I', signature).tobytes(),
+             datetime.now().isoformat())
+        ).rowcount
+        if not inserted:
+            (claimed_by,) = conn.execute(
+                "SELECT claimed_by FROM near_dup_signatures "
+                "WHERE account_key = ? AND spreadsheet_name = ? AND content_hash = ?",
+                (owner, spreadsheet_name, content_hash)
+            ).fetchone()
+            return None if claimed_by == claimant else content_hash
+        conn.executemany(
+            "INSERT INTO near_dup_buckets VALUES (?, ?, ?, ?)",
+            [(owner, spreadsheet_name, bucket, content_hash) for bucket in buckets]
+        )
+    return None
+
+def release_near_duplicate(owner: str, spreadsheet_name: str, item: dict):
+    """Membatalkan pendaftaran CV yang gagal diproses agar CV serupa tidak ikut dilewati."""
+    claimant = json.dumps(attachment_index_key(item['message_id'], item['part']))
+    with state_db() as conn:
+        deleted = conn.execute(
+            "DELETE FROM near_dup_signatures "
+            "WHERE account_key = ? AND spreadsheet_name = ? AND content_hash = ? AND claimed_by = ?",
+            (owner, spreadsheet_name, item['content_hash'], claimant)
+        ).rowcount
+        if deleted:
+            conn.execute(
+                "DELETE FROM near_dup_buckets WHERE account_key = ? AND spreadsheet_name = ? AND content_hash = ?",
+                (owner, spreadsheet_name, item['content_hash'])
+            )
+
+def clear_near_dup_index(owner: str, spreadsheet_name: str):
+    with state_db() as conn:
+        for table in ('near_dup_signatures', 'near_dup_buckets'):
+            conn.execute(
+                f"DELETE FROM {table} WHERE account_key = ? AND spreadsheet_name = ?", (owner, spreadsheet_name)
+            )
+
+def update_prefilter_corpus(owner: str, spreadsheet_name: str, documents, query_text: str = ""):
+    """
+    Menambahkan resume (content_hash, teks) yang belum tercatat ke korpus pre-filter posisi ini;
+    setiap isi PDF dihitung sekali. Return (jumlah dokumen korpus, document frequency) untuk
+    term di resume tersebut dan di query_text.
+    """
+    terms_by_document = {
+        content_hash: set(PREFILTER_TOKEN_PATTERN.findall(text.lower())) for content_hash, text in documents
+    }
+    lookup_terms = list(set(PREFILTER_TOKEN_PATTERN.findall(query_text.lower())).union(*terms_by_document.values()))
+    with state_db() as conn:
+        new_counts = {}
+        for content_hash, terms in terms_by_document.items():
+            if conn.execute(
+                "INSERT OR IGNORE INTO prefilter_documents VALUES (?, ?, ?)", (owner, spreadsheet_name, content_hash)
+            ).rowcount:
+                for term in terms:
+                    new_counts[term] = new_counts.get(term, 0) + 1
+        conn.executemany(
+            "INSERT INTO prefilter_terms VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (account_key, spreadsheet_name, term) "
+            "DO UPDATE SET document_frequency = document_frequency + excluded.document_frequency",
+            [(owner, spreadsheet_name, term, count) for term, count in new_counts.items()]
+        )
+        document_count = conn.execute(
+            "SELECT COUNT(*) FROM prefilter_documents WHERE account_key = ? AND spreadsheet_name = ?",
+            (owner, spreadsheet_name)
+        ).fetchone()[0]
+        document_frequency = {}
+        for start in range(0, len(lookup_terms), 500):
+            chunk = lookup_terms[start:start + 500]
+            document_frequency.update(conn.execute(
+                f"SELECT term, document_frequency FROM prefilter_terms WHERE account_key = ? AND spreadsheet_name = ? "
+                f"AND term IN ({', '.join('?' * len(chunk))})",
+                (owner, spreadsheet_name, *chunk)
+            ).fetchall())
+    return document_count, document_frequency
+
+def clear_prefilter_corpus(owner: str, spreadsheet_name: str):
+    with state_db() as conn:
+        for table in ('prefilter_documents', 'prefilter_terms'):
+            conn.execute(
+                f"DELETE FROM {table} WHERE account_key = ? AND spreadsheet_name = ?", (owner, spreadsheet_name)
+            )
+
+def work_blob_path(content_hash: str) -> str:
+    return os.path.join(WORK_BLOB_DIR, f"{content_hash}.pdf")
+
+def save_work_blob(content_hash: str, file_data: bytes):
+    """Menyimpan PDF lampiran ke disk (atomic rename) agar run berikutnya tidak perlu mengunduh ulang."""
+    path = work_blob_path(content_hash)
+    if os.path.exists(path):
+        return
+    os.makedirs(WORK_BLOB_DIR, exist_ok=True)
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(file_data)
+    os.replace(tmp_path, path)
+
+def load_work_blob(content_hash: str) -> Optional[bytes]:
+    try:
+        with open(work_blob_path(content_hash), 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+def enqueue_work_items(owner: str, spreadsheet_name: str, pdf_parts):
+    """Mendaftarkan lampiran baru ke antrean kerja; item yang sudah ada mempertahankan state-nya."""
+    now = datetime.now().isoformat()
+    with state_db() as conn:
+        conn.executemany(
+            "INSERT OR IGNORE INTO work_items (account_key, spreadsheet_name, message_id, part_id, size, part, state, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, 'pending', ?)",
+            [
+                (owner, spreadsheet_name, *attachment_index_key(message_id, part), json.dumps(part), now)
+                for message_id, part in pdf_parts
+            ]
+        )
+
+WORK_ITEM_COLUMNS = "message_id, part, state, attempts, content_hash, resume_text, cv_hash, drive_link, analysis"
+
+def load_work_items(owner: str, spreadsheet_name: str) -> List[dict]:
+    """
+    Item antrean yang belum tertulis ke spreadsheet dan belum melewati WORK_MAX_ATTEMPTS,
+    termasuk sisa run sebelumnya yang terputus atau gagal. Item yang tertunda pre-filter
+    ('filtered') dimuat terpisah lewat load_filtered_work_items.
+    """
+    with state_db() as conn:
+        rows = conn.execute(
+            f"SELECT {WORK_ITEM_COLUMNS} FROM work_items WHERE account_key = ? AND spreadsheet_name = ? "
+            "AND state NOT IN ('written', 'skipped', 'filtered') AND attempts < ? ORDER BY updated_at",
+            (owner, spreadsheet_name, WORK_MAX_ATTEMPTS)
+        ).fetchall()
+    return work_items_from_rows(rows)
+
+def has_pending_work_items(owner: str, spreadsheet_name: str) -> bool:
+    """
+    Antrean masih berisi item yang akan diproses load_work_items (atau item tertunda pre-filter
+    jika PREFILTER_METHOD aktif), sehingga pipeline perlu jalan walau tidak ada email baru.
+    """
+    with state_db() as conn:
+        row = conn.execute(
+            "SELECT 1 FROM work_items WHERE account_key = ? AND spreadsheet_name = ? AND "
+            "((state NOT IN ('written', 'skipped', 'filtered') AND attempts < ?) OR (state = 'filtered' AND ?)) LIMIT 1",
+            (owner, spreadsheet_name, WORK_MAX_ATTEMPTS, bool(PREFILTER_METHOD))
+        ).fetchone()
+    return row is not None
+
+def load_filtered_work_items(owner: str, spreadsheet_name: str) -> List[dict]:
+    """Item yang belum lolos pre-filter di run sebelumnya (teksnya tersimpan) untuk dinilai ulang."""
+    with state_db() as conn:
+        rows = conn.execute(
+            f"SELECT {WORK_ITEM_COLUMNS} FROM work_items WHERE account_key = ? AND spreadsheet_name = ? "
+            "AND state = 'filtered' ORDER BY updated_at",
+            (owner, spreadsheet_name)
+        ).fetchall()
+    return work_items_from_rows(rows)
+
+def work_items_from_rows(rows) -> List[dict]:
+    return [
+        {
+            'message_id': message_id,
+            'part': json.loads(part),
+            'state': state,
+            'attempts': attempts,
+            'content_hash': content_hash,
+            'resume_text': resume_text,
+            'cv_hash': cv_hash,
+            'drive_link': drive_link,
+            'analysis': json.loads(analysis) if analysis else None,
+        }
+        for message_id, part, state, attempts, content_hash, resume_text, cv_hash, drive_link, analysis in rows
+    ]
+
+def update_work_item(owner: str, spreadsheet_name: str, item: dict, **fields):
+    """Memajukan state item antrean dan menyimpan hasil tahap yang sudah selesai."""
+    item.update(fields)
+    if 'analysis' in fields:
+        fields['analysis'] = json.dumps(fields['analysis'], ensure_ascii=False)
+    assignments = ', '.join(f"{column} = ?" for column in fields)
+    with state_db() as conn:
+        conn.execute(
+            f"UPDATE work_items SET {assignments}, updated_at = ? "
+            "WHERE account_key = ? AND spreadsheet_name = ? AND message_id = ? AND part_id = ? AND size = ?",
+            (*fields.values(), datetime.now().isoformat(), owner, spreadsheet_name,
+             *attachment_index_key(item['message_id'], item['part']))
+        )
+
+def fail_work_item(owner: str, spreadsheet_name: str, item: dict, error: str):
+    """Mencatat kegagalan: attempts bertambah, state tetap di tahap terakhir yang berhasil."""
+    item['attempts'] += 1
+    update_work_item(owner, spreadsheet_name, item, attempts=item['attempts'], last_error=error)
+
+def finish_work_item(owner: str, spreadsheet_name: str, item: dict, state: str = 'written'):
+    """
+    Menandai item selesai ('written', atau 'skipped' untuk duplikat) dan membuang data antara.
+    File PDF dihapus jika tidak ada item lain (akun mana pun) yang masih membutuhkannya.
+    """
+    update_work_item(owner, spreadsheet_name, item, state=state, resume_text=None, analysis=None)
+    content_hash = item.get('content_hash')
+    if not content_hash:
+        return
+    with state_db() as conn:
+        in_use = conn.execute(
+            "SELECT 1 FROM work_items WHERE content_hash = ? AND state NOT IN ('written', 'skipped') LIMIT 1",
+            (content_hash,)
+        ).fetchone()
+    if in_use is None:
+        try:
+            os.remove(work_blob_path(content_hash))
+        except FileNotFoundError:
+            pass
+
+def clear_work_items(owner: str, spreadsheet_name: str):
+    """Mengosongkan antrean kerja sebuah spreadsheet beserta file PDF yang tidak dipakai antrean lain."""
+    with state_db() as conn:
+        hashes = {
+            content_hash for (content_hash,) in conn.execute(
+                "SELECT DISTINCT content_hash FROM work_items "
+                "WHERE account_key = ? AND spreadsheet_name = ? AND content_hash IS NOT NULL",
+                (owner, spreadsheet_name)
+            ).fetchall()
+        }
+        conn.execute(
+            "DELETE FROM work_items WHERE account_key = ? AND spreadsheet_name = ?", (owner, spreadsheet_name)
+        )
+        in_use = {
+            content_hash for (content_hash,) in conn.execute(
+                "SELECT DISTINCT content_hash FROM work_items WHERE content_hash IS NOT NULL "
+                "AND state NOT IN ('written', 'skipped')"
+            ).fetchall()
+        }
+    for content_hash in hashes - in_use:
+        try:
+            os.remove(work_blob_path(content_hash))
+        except FileNotFoundError:
+            pass
+
+def lookup_drive_file(owner: str, content_hash: str):
+    """File Drive yang sudah pernah diupload untuk PDF dengan hash isi ini: (file_id, shared) atau None."""
+    with state_db() as conn:
+        return conn.execute(
+            "SELECT file_id, shared FROM drive_files WHERE account_key = ? AND content_hash = ?",
+            (owner, content_hash)
+        ).fetchone()
+
+def store_drive_file(owner: str, content_hash: str, file_id: str):
+    with state_db() as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO drive_files VALUES (?, ?, ?, 0, ?)",
+            (owner, content_hash, file_id, datetime.now().isoformat())
+        )
+
+def mark_drive_files_shared(owner: str, file_ids: List[str]):
+    with state_db() as conn:
+        conn.executemany(
+            "UPDATE drive_files SET shared = 1 WHERE account_key = ? AND file_id = ?",
+            [(owner, file_id) for file_id in file_ids]
+        )
+
+def forget_drive_file(owner: str, content_hash: str):
+    with state_db() as conn:
+        conn.execute(
+            "DELETE FROM drive_files WHERE account_key = ? AND content_hash = ?", (owner, content_hash)
+        )
+
+def analysis_cache_key(job_desc: str, resume_text: str) -> str:
+    """Kunci cache: hash dari teks yang benar-benar dikirim ke Gemini, versi prompt, dan nama model."""
+    content = "\0".join([ANALYSIS_PROMPT_VERSION, GEMINI_MODEL_NAME, job_desc[:2000], resume_text[:5000]])
+    return hashlib.sha256(content.encode()).hexdigest()
+
+def get_cached_analysis(cache_key: str) -> Optional[dict]:
+    """Mengambil hasil analisis dari cache lokal dan memperbarui waktu akses (LRU)."""
+    with state_db() as conn:
+        row = conn.execute("SELECT result FROM analysis_cache WHERE cache_key = ?", (cache_key,)).fetchone()
+        if row is None:
+            return None
+        conn.execute("UPDATE analysis_cache SET last_access = ? WHERE cache_key = ?", (time.time(), cache_key))
+    return json.loads(row[0])
+
+def store_cached_analysis(cache_key: str, result: dict):
+    """Menyimpan hasil analisis, lalu membuang entri yang paling lama tidak diakses jika melewati batas ukuran."""
+    payload = json.dumps(result, ensure_ascii=False)
+    with state_db() as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO analysis_cache VALUES (?, ?, ?, ?)",
+            (cache_key, payload, len(payload.encode()), time.time())
+        )
+        total_size = conn.execute("SELECT COALESCE(SUM(size), 0) FROM analysis_cache").fetchone()[0]
+        if total_size <= ANALYSIS_CACHE_MAX_BYTES:
+            return
+        excess = total_size - ANALYSIS_CACHE_MAX_BYTES
+        evicted = 0
+        for old_key, size in conn.execute(
+            "SELECT cache_key, size FROM analysis_cache ORDER BY last_access"
+        ).fetchall():
+            if evicted >= excess:
+                break
+            conn.execute("DELETE FROM analysis_cache WHERE cache_key = ?", (old_key,))
+            evicted += size
+
+def sync_sheet_hashes(sheet) -> set:
+    """
+    Sinkronisasi inkremental kolom CV_Hash ke index lokal, lalu return set hash-nya.
+    Range yang dibaca dimulai dari baris terakhir yang sudah disinkronkan; jika nilai baris
+    itu berubah (sheet dikosongkan atau diedit), index dibangun ulang dari baris 2.
+    """
+    spreadsheet_id = sheet.spreadsheet.id
+    with state_db() as conn:
+        row = conn.execute(
+            "SELECT synced_rows FROM sheet_hash_sync WHERE spreadsheet_id = ?", (spreadsheet_id,)
+        ).fetchone()
+        synced_rows = row[0] if row else 1
+        last_hash = conn.execute(
+            "SELECT cv_hash FROM sheet_hashes WHERE spreadsheet_id = ? AND row_number = ?",
+            (spreadsheet_id, synced_rows)
+        ).fetchone() if synced_rows > 1 else None
+
+    start_row = synced_rows if synced_rows > 1 else 2
+    values = sheet.get(f"{CV_HASH_COLUMN}{start_row}:{CV_HASH_COLUMN}")
+    column = [cells[0] if cells else '' for cells in values]
+
+    if synced_rows > 1 and (not column or last_hash is None or column[0] != last_hash[0]):
+        print("Index hash lokal tidak cocok dengan spreadsheet, sinkronisasi ulang penuh")
+        clear_sheet_hashes(spreadsheet_id)
+        return sync_sheet_hashes(sheet)
+
+    with state_db() as conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO sheet_hashes VALUES (?, ?, ?)",
+            [
+                (spreadsheet_id, start_row + offset, cv_hash)
+                for offset, cv_hash in enumerate(column) if cv_hash
+            ]
+        )
+        last_row = start_row + len(column) - 1
+        if column:
+            conn.execute(
+                "INSERT OR REPLACE INTO sheet_hash_sync VALUES (?, ?)", (spreadsheet_id, max(last_row, synced_rows))
+            )
+        hashes = conn.execute(
+            "SELECT cv_hash FROM sheet_hashes WHERE spreadsheet_id = ?", (spreadsheet_id,)
+        ).fetchall()
+    return {cv_hash for (cv_hash,) in hashes}
+
+def clear_sheet_hashes(spreadsheet_id: str):
+    """Menghapus index hash lokal sebuah spreadsheet."""
+    with state_db() as conn:
+        conn.execute("DELETE FROM sheet_hashes WHERE spreadsheet_id = ?", (spreadsheet_id,))
+        conn.execute("DELETE FROM sheet_hash_sync WHERE spreadsheet_id = ?", (spreadsheet_id,))
+
+def lookup_spreadsheet_id(owner: str, spreadsheet_name: str) -> Optional[str]:
+    """ID spreadsheet dari registry nama -> ID milik sebuah akun, None jika belum terdaftar."""
+    with state_db() as conn:
+        row = conn.execute(
+            "SELECT spreadsheet_id FROM spreadsheet_registry WHERE account_key = ? AND spreadsheet_name = ?",
+            (owner, spreadsheet_name)
+        ).fetchone()
+    return row[0] if row else None
+
+def register_spreadsheets(owner: str, spreadsheet_ids: dict):
+    """Mencatat pasangan nama -> ID spreadsheet (saat dibuat, ditemukan, atau dari list-spreadsheets)."""
+    now = datetime.now().isoformat()
+    with state_db() as conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO spreadsheet_registry VALUES (?, ?, ?, ?)",
+            [(owner, name, spreadsheet_id, now) for name, spreadsheet_id in spreadsheet_ids.items()]
+        )
+
+def forget_spreadsheet(owner: str, spreadsheet_name: str):
+    with state_db() as conn:
+        conn.execute(
+            "DELETE FROM spreadsheet_registry WHERE account_key = ? AND spreadsheet_name = ?",
+            (owner, spreadsheet_name)
+        )
+
+def result_row_values(row_number: int, record: dict):
+    """Baris tabel result_rows dari satu record hasil (tanpa CV_Hash)."""
+    try:
+        overall_fit = int(record.get('Overall Fit'))
+    except (TypeError, ValueError):
+        overall_fit = None
+    return row_number, str(record.get('Waktu', '')), overall_fit, json.dumps(record, ensure_ascii=False)
+
+# Kolom urutan yang didukung /api/get-results; baris tanpa Overall Fit numerik diurutkan sebagai -1.
+# Setiap ekspresi punya index (spreadsheet_id, ekspresi, row_number) sehingga query top-N hanya membaca N baris.
+RESULT_SORT_EXPRESSIONS = {
+    'overall_fit': 'COALESCE(overall_fit, -1)',
+    'waktu': 'waktu',
+}
+
+def load_results_sync(spreadsheet_id: str):
+    """Return (sudah_disinkronkan, modified_time) mirror hasil sebuah spreadsheet."""
+    with state_db() as conn:
+        sync = conn.execute(
+            "SELECT modified_time FROM result_sync WHERE spreadsheet_id = ?", (spreadsheet_id,)
+        ).fetchone()
+    return (True, sync[0]) if sync else (False, None)
+
+def query_results_mirror(spreadsheet_id: str, sort: Optional[str] = None, descending: bool = False,
+                         limit: Optional[int] = None, after: Optional[list] = None, min_fit: Optional[int] = None):
+    """
+    Mengambil hasil dari mirror lokal dengan keyset pagination. Tanpa sort, urutan mengikuti
+    baris spreadsheet. `after` adalah kunci baris terakhir halaman sebelumnya
+    ([nilai_sort, row_number], atau [row_number] tanpa sort).
+    Return (records, next_key); next_key None jika tidak ada halaman berikutnya.
+    """
+    key_columns = ([RESULT_SORT_EXPRESSIONS[sort]] if sort else []) + ['row_number']
+    conditions = ['spreadsheet_id = ?']
+    params = [spreadsheet_id]
+    if min_fit is not None:
+        conditions.append(f"{RESULT_SORT_EXPRESSIONS['overall_fit']} >= ?")
+        params.append(min_fit)
+    if after is not None:
+        conditions.append(f"({', '.join(key_columns)}) {'<' if descending else '>'} ({', '.join('?' * len(key_columns))})")
+        params.extend(after)
+    direction = 'DESC' if descending else 'ASC'
+    query = (
+        f"SELECT {', '.join(key_columns)}, data FROM result_rows WHERE {' AND '.join(conditions)} "
+        f"ORDER BY {', '.join(f'{column} {direction}' for column in key_columns)}"
+    )
+    if limit is not None:
+        query += " LIMIT ?"
+        params.append(limit + 1)
+    with state_db() as conn:
+        rows = conn.execute(query, params).fetchall()
+
+    next_key = None
+    if limit is not None and len(rows) > limit:
+        rows = rows[:limit]
+        next_key = list(rows[-1][:-1])
+    return [json.loads(row[-1]) for row in rows], next_key
+
+def encode_results_cursor(sort: Optional[str], order: str, key: list) -> str:
+    """Cursor opaque untuk halaman berikutnya; sort dan order ikut disimpan agar cursor tidak dipakai lintas urutan."""
+    return base64.urlsafe_b64encode(json.dumps([sort, order, key]).encode()).decode()
+
+def decode_results_cursor(cursor: str, sort: Optional[str], order: str) -> list:
+    try:
+        cursor_sort, cursor_order, key = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except Exception:
+        raise HTTPException(status_code=400, detail="Cursor tidak valid")
+    if cursor_sort != sort or cursor_order != order or not isinstance(key, list) or len(key) != (2 if sort else 1):
+        raise HTTPException(status_code=400, detail="Cursor tidak cocok dengan parameter sort/order")
+    return key
+
+def replace_results_mirror(spreadsheet_id: str, records: List[dict], modified_time: Optional[str]):
+    """Mengganti isi mirror dengan hasil get_all_records; modified_time adalah modifiedTime Drive sebelum dibaca."""
+    with state_db() as conn:
+        conn.execute("DELETE FROM result_rows WHERE spreadsheet_id = ?", (spreadsheet_id,))
+        conn.executemany(
+            "INSERT INTO result_rows VALUES (?, ?, ?, ?, ?)",
+            [
+                (spreadsheet_id, *result_row_values(row_number, record))
+                for row_number, record in enumerate(records, start=2)
+            ]
+        )
+        conn.execute(
+            "INSERT OR REPLACE INTO result_sync VALUES (?, ?, ?)",
+            (spreadsheet_id, modified_time, datetime.now().isoformat())
+        )
+
+def append_results_mirror(spreadsheet_id: str, first_row: int, records: List[dict]):
+    """Write-through dari SheetWriter: baris yang baru ditulis langsung masuk mirror (jika mirror sudah ada)."""
+    with state_db() as conn:
+        if conn.execute("SELECT 1 FROM result_sync WHERE spreadsheet_id = ?", (spreadsheet_id,)).fetchone() is None:
+            return
+        conn.executemany(
+            "INSERT OR REPLACE INTO result_rows VALUES (?, ?, ?, ?, ?)",
+            [
+                (spreadsheet_id, *result_row_values(row_number, record))
+                for row_number, record in enumerate(records, start=first_row)
+            ]
+        )
+
+def clear_results_mirror(spreadsheet_id: str):
+    """Menghapus mirror hasil sebuah spreadsheet; pembacaan berikutnya menyinkronkan ulang dari sheet."""
+    with state_db() as conn:
+        conn.execute("DELETE FROM result_rows WHERE spreadsheet_id = ?", (spreadsheet_id,))
+        conn.execute("DELETE FROM result_sync WHERE spreadsheet_id = ?", (spreadsheet_id,))
+
+def find_spreadsheet_file(drive, owner: str, spreadsheet_name: str) -> Optional[dict]:
+    """
+    Mencari spreadsheet berdasarkan nama lewat Drive saja (tanpa membaca metadata Sheets).
+    ID dari registry dibaca dengan files.get; pencarian nama hanya untuk nama yang belum
+    terdaftar. Return {'id', 'modifiedTime'} atau None jika tidak ditemukan.
+    """
+    spreadsheet_id = lookup_spreadsheet_id(owner, spreadsheet_name)
+    if spreadsheet_id:
+        try:
+            spreadsheet_file = drive.files().get(
+                fileId=spreadsheet_id, fields='id, name, modifiedTime, trashed'
+            ).execute()
+            if spreadsheet_file.get('name') == spreadsheet_name and not spreadsheet_file.get('trashed'):
+                return spreadsheet_file
+        except HttpError as e:
+            if e.resp.status not in (403, 404):
+                raise
+        forget_spreadsheet(owner, spreadsheet_name)
+
+    escaped_name = spreadsheet_name.replace('\\', '\\\\').replace("'", "\\'")
+    response = drive.files().list(
+        q=f"name = '{escaped_name}' and mimeType = 'application/vnd.google-apps.spreadsheet' and trashed = false",
+        fields='files(id, modifiedTime)',
+        pageSize=1
+    ).execute()
+    files = response.get('files', [])
+    if not files:
+        return None
+    register_spreadsheets(owner, {spreadsheet_name: files[0]['id']})
+    return files[0]
+
+def sync_results_mirror(gc, spreadsheet_id: str, modified_time: Optional[str]):
+    """Membaca ulang seluruh hasil dari spreadsheet ke mirror lokal (CV_Hash tidak disimpan)."""
+    records = gc.open_by_key(spreadsheet_id).sheet1.get_all_records()
+    replace_results_mirror(
+        spreadsheet_id,
+        [{k: v for k, v in record.items() if k != 'CV_Hash'} for record in records],
+        modified_time
+    )
+    return records
+
+_results_refresh_lock = threading.Lock()
+_results_refreshing = set()
+
+def refresh_results_mirror(gc, spreadsheet_id: str, modified_time: Optional[str]):
+    """Sinkronisasi mirror di background; hanya satu refresh per spreadsheet yang berjalan bersamaan."""
+    with _results_refresh_lock:
+        if spreadsheet_id in _results_refreshing:
+            return
+        _results_refreshing.add(spreadsheet_id)
+    try:
+        sync_results_mirror(gc, spreadsheet_id, modified_time)
+    except Exception as e:
+        print(f"Gagal sinkronisasi mirror hasil {spreadsheet_id}: {e}")
+    finally:
+        with _results_refresh_lock:
+            _results_refreshing.discard(spreadsheet_id)
+
+_results_checked_at = {}
+
+def should_check_results_mirror(spreadsheet_id: str) -> bool:
+    """True paling sering sekali per RESULTS_CHECK_INTERVAL detik untuk setiap spreadsheet."""
+    now = time.monotonic()
+    with _results_refresh_lock:
+        if now - _results_checked_at.get(spreadsheet_id, float('-inf')) < RESULTS_CHECK_INTERVAL:
+            return False
+        _results_checked_at[spreadsheet_id] = now
+    return True
+
+def check_results_mirror(creds: Credentials, owner: str, spreadsheet_name: str):
+    """
+    Pengecekan background untuk mirror yang sudah dipakai menjawab request: spreadsheet dicari
+    lewat Drive (modifiedTime), lalu mirror disinkronkan ulang jika spreadsheet berubah.
+    Spreadsheet yang hilang dikeluarkan dari registry oleh find_spreadsheet_file, sehingga
+    request berikutnya kembali ke jalur lambat.
+    """
+    try:
+        _, drive, gc, _ = build_google_services(creds)
+        spreadsheet_file = find_spreadsheet_file(drive, owner, spreadsheet_name)
+    except Exception as e:
+        print(f"Gagal memeriksa spreadsheet {spreadsheet_name}: {e}")
+        return
+    if spreadsheet_file is None:
+        return
+    synced, synced_modified_time = load_results_sync(spreadsheet_file['id'])
+    if not synced or spreadsheet_file.get('modifiedTime') != synced_modified_time:
+        refresh_results_mirror(gc, spreadsheet_file['id'], spreadsheet_file.get('modifiedTime'))
+
+# ==============================================================================
+# SCHEDULER GEMINI (RATE LIMIT & RETRY)
+# ==============================================================================
+class TokenBucket:
+    """Token bucket thread-safe yang diisi ulang secara kontinu sebesar rate_per_minute."""
+
+    def __init__(self, rate_per_minute: int):
+        self.capacity = max(rate_per_minute, 1)
+        self.tokens = float(self.capacity)
+        self.refill_per_second = self.capacity / 60.0
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.refill_per_second)
+        self.updated_at = now
+
+    def try_acquire(self, amount: float) -> float:
+        """Ambil token jika cukup dan return 0, jika tidak return lama waktu tunggu (detik)."""
+        amount = min(amount, self.capacity)
+        with self.lock:
+            self._refill()
+            if self.tokens >= amount:
+                self.tokens -= amount
+                return 0.0
+            return (amount - self.tokens) / self.refill_per_second
+
+    def adjust(self, amount: float):
+        """Koreksi pemakaian setelah jumlah token sebenarnya diketahui (positif = tambahan pemakaian)."""
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.capacity, self.tokens - amount)
+
+    async def acquire(self, amount: float):
+        while True:
+            wait = self.try_acquire(amount)
+            if wait <= 0:
+                return
+            await asyncio.sleep(wait)
+
+class GeminiScheduler:
+    """
+    Menjadwalkan panggilan generate_content_async sesuai kuota RPM/TPM, membatasi
+    jumlah request yang berjalan bersamaan, dan me-retry 429/5xx dengan exponential
+    backoff + jitter.
+    """
+    RETRYABLE_ERRORS = (
+        google_exceptions.ResourceExhausted,
+        google_exceptions.TooManyRequests,
+        google_exceptions.InternalServerError,
+        google_exceptions.ServiceUnavailable,
+        google_exceptions.DeadlineExceeded,
+    )
+
+    def __init__(self, rpm: int, tpm: int, max_in_flight: int, max_retries: int):
+        self.request_bucket = TokenBucket(rpm)
+        self.token_bucket = TokenBucket(tpm)
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self._in_flight = None
+        self._loop = None
+
+    def _get_in_flight(self) -> asyncio.Semaphore:
+        # Semaphore asyncio terikat ke event loop, jadi dibuat ulang jika loop berganti
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._in_flight = asyncio.Semaphore(self.max_in_flight)
+        return self._in_flight
+
+    @staticmethod
+    def estimate_tokens(prompt: str) -> int:
+        return len(prompt) // 4 + GEMINI_OUTPUT_TOKEN_ESTIMATE
+
+    async def generate(self, model, prompt, **kwargs):
+        estimated_tokens = self.estimate_tokens(str(prompt))
+        async with self._get_in_flight():
+            for attempt in range(self.max_retries + 1):
+                await self.request_bucket.acquire(1)
+                await self.token_bucket.acquire(estimated_tokens)
+                try:
+                    response = await model.generate_content_async(prompt, **kwargs)
+                except self.RETRYABLE_ERRORS as e:
+                    if attempt >= self.max_retries:
+                        raise
+                    delay = random.uniform(0, min(60.0, 2.0 * (2 ** attempt)))
+                    print(f"Gemini error ({type(e).__name__}), retry {attempt + 1} dalam {delay:.1f} detik")
+                    await asyncio.sleep(delay)
+                    continue
+                usage = getattr(response, 'usage_metadata', None)
+                if usage is not None and getattr(usage, 'total_token_count', 0):
+                    self.token_bucket.adjust(usage.total_token_count - estimated_tokens)
+                return response
+
+gemini_scheduler = GeminiScheduler(GEMINI_RPM, GEMINI_TPM, GEMINI_MAX_IN_FLIGHT, GEMINI_MAX_RETRIES)
+
+# ==============================================================================
+# FETCH GMAIL (BATCH)
+# ==============================================================================
+def is_retryable_batch_error(exception) -> bool:
+    """Sub-request batch yang layak dicoba ulang: rate limit (429) atau error server (5xx)."""
+    return isinstance(exception, HttpError) and (exception.resp.status == 429 or exception.resp.status >= 500)
+
+def execute_batch(service, requests, batch_size: int, http=None, max_retries: int = BATCH_MAX_RETRIES):
+    """
+    Menjalankan banyak request Gmail/Drive lewat batch HTTP API (maksimal 100 per batch).
+    `requests` berupa list (key, HttpRequest); return (responses, errors) berupa dict per key.
+    Sub-request yang gagal 429/5xx dikirim ulang dalam batch berikutnya dengan exponential
+    backoff + jitter; hanya error yang tersisa setelah max_retries yang masuk `errors`.
+    """
+    responses, errors = {}, {}
+    for start in range(0, len(requests), batch_size):
+        chunk = requests[start:start + batch_size]
+        for attempt in range(max_retries + 1):
+            keys = {str(i): key for i, (key, _) in enumerate(chunk)}
+
+            def callback(request_id, response, exception):
+                key = keys[request_id]
+                if exception is not None:
+                    errors[key] = exception
+                else:
+                    errors.pop(key, None)
+                    responses[key] = response
+
+            batch = service.new_batch_http_request(callback=callback)
+            for i, (_, service_request) in enumerate(chunk):
+                batch.add(service_request, request_id=str(i))
+            batch.execute(http=http)
+
+            chunk = [(key, service_request) for key, service_request in chunk
+                     if key in errors and is_retryable_batch_error(errors[key])]
+            if not chunk or attempt >= max_retries:
+                break
+            delay = random.uniform(0, min(30.0, 2.0 * (2 ** attempt)))
+            print(f"{len(chunk)} sub-request batch gagal (429/5xx), retry {attempt + 1} dalam {delay:.1f} detik")
+            time.sleep(delay)
+    return responses, errors
+
+def list_message_ids(gmail, gmail_query: str, http=None) -> List[str]:
+    """Menelusuri semua halaman messages().list (nextPageToken) untuk query yang diberikan."""
+    message_ids = []
+    page_token = None
+    while True:
+        results = gmail.users().messages().list(
+            userId='me',
+            q=gmail_query,
+            maxResults=GMAIL_LIST_PAGE_SIZE,
+            pageToken=page_token,
+            fields='messages/id,nextPageToken'
+        ).execute(http=http)
+        message_ids.extend(message['id'] for message in results.get('messages', []))
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            return message_ids
+
+def fetch_message_parts(gmail, message_ids: List[str], http=None):
+    """
+    Mengambil metadata banyak email sekaligus. Return (messages, failed_message_ids) dengan
+    messages berupa dict message_id -> (internalDate, list part lampiran PDF).
+    """
+    requests = [
+        (message_id, gmail.users().messages().get(userId='me', id=message_id, fields=GMAIL_MESSAGE_FIELDS))
+        for message_id in message_ids
+    ]
+    responses, errors = execute_batch(gmail, requests, GMAIL_BATCH_SIZE, http=http)
+    for message_id, error in errors.items():
+        print(f"Error processing message {message_id}: {error}")
+
+    messages = {}
+    for message_id, msg in responses.items():
+        # Periksa apakah email memiliki attachments
+        pdf_parts = [
+            part for part in msg.get('payload', {}).get('parts', [])
+            if part.get('filename', '') and part['filename'].lower().endswith('.pdf')
+        ]
+        messages[message_id] = (int(msg.get('internalDate', 0)), pdf_parts)
+    return messages, set(errors)
+
+def select_pdf_parts(messages: dict, message_ids: List[str], min_internal_date: int = 0):
+    """
+    Lampiran PDF (message_id, part) dari email yang internalDate-nya > min_internal_date
+    (belum tercakup cursor). Return (pdf_parts, message_dates) dengan message_dates berisi
+    internalDate per email.
+    """
+    pdf_parts = []
+    message_dates = {}
+    for message_id in message_ids:
+        if message_id not in messages:
+            continue
+        internal_date, parts = messages[message_id]
+        if internal_date <= min_internal_date:
+            continue
+        message_dates[message_id] = internal_date
+        pdf_parts.extend((message_id, part) for part in parts)
+    return pdf_parts, message_dates
+
+def fetch_pdf_parts(gmail, message_ids: List[str], min_internal_date: int = 0, http=None):
+    """
+    Mengambil daftar lampiran PDF (message_id, part) dari banyak email sekaligus.
+    Email dengan internalDate <= min_internal_date (sudah tercakup cursor) dilewati.
+    Return (pdf_parts, message_dates, failed_message_ids) dengan message_dates berisi
+    internalDate per email.
+    """
+    messages, failed_message_ids = fetch_message_parts(gmail, message_ids, http=http)
+    pdf_parts, message_dates = select_pdf_parts(messages, message_ids, min_internal_date)
+    return pdf_parts, message_dates, failed_message_ids
+
+def fetch_pdf_attachments(gmail, pdf_parts, http=None):
+    """
+    Mengunduh isi lampiran PDF dalam satu batch request.
+    Return (fetched, failed_message_ids) dengan fetched berupa list (message_id, part, file_data).
+    """
+    requests = []
+    for index, (message_id, part) in enumerate(pdf_parts):
+        attachment_id = part.get('body', {}).get('attachmentId')
+        if not attachment_id:
+            print(f"Lampiran {part.get('filename', '')} tidak memiliki attachmentId, skip.")
+            continue
+        requests.append((index, gmail.users().messages().attachments().get(
+            userId='me',
+            messageId=message_id,
+            id=attachment_id,
+            fields='data'
+        )))
+    responses, errors = execute_batch(gmail, requests, GMAIL_ATTACHMENT_BATCH_SIZE, http=http)
+
+    fetched = []
+    failed_message_ids = set()
+    for index, (message_id, part) in enumerate(pdf_parts):
+        if index in errors:
+            print(f"Error processing attachment {part.get('filename', '')}: {errors[index]}")
+            failed_message_ids.add(message_id)
+            continue
+        if index in responses:
+            file_data = base64.urlsafe_b64decode(responses[index]['data'].encode('UTF-8'))
+            fetched.append((message_id, part, file_data))
+    return fetched, failed_message_ids
+
+# ==============================================================================
+# PENULISAN SPREADSHEET (BUFFERED)
+# ==============================================================================
+class SheetWriter:
+    """
+    Write-behind buffer untuk baris hasil screening. Baris dikumpulkan lalu ditulis dengan
+    satu append_rows setiap flush_rows baris atau flush_interval detik. Jika penulisan gagal
+    (mis. kuota 429), baris masuk antrean retry dan dicoba lagi pada flush berikutnya;
+    close() mencoba ulang dengan backoff sebelum menyerah.
+
+    on_written(contexts, first_row) dipanggil setelah baris berhasil ditulis, dengan first_row
+    nomor baris spreadsheet dari baris pertama (None jika tidak diketahui), dan on_failed(contexts)
+    untuk baris yang tetap gagal setelah close().
+    """
+
+    def __init__(self, sheet, on_written=None, on_failed=None, flush_rows: int = SHEET_FLUSH_ROWS,
+                 flush_interval: float = SHEET_FLUSH_INTERVAL, max_retries: int = SHEET_MAX_RETRIES):
+        self.sheet = sheet
+        self.on_written = on_written
+        self.on_failed = on_failed
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.buffer = []
+        self.retry_queue = []
+        self.write_requests = 0
+        self.lock = asyncio.Lock()
+        self.timer_task = None
+
+    async def add(self, row: list, context=None):
+        self.buffer.append((row, context))
+        if self.timer_task is None:
+            self.timer_task = asyncio.ensure_future(self._flush_periodically())
+        if len(self.buffer) >= self.flush_rows:
+            await self.flush()
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            if self.buffer or self.retry_queue:
+                await self.flush()
+
+    async def flush(self) -> bool:
+        async with self.lock:
+            entries = self.retry_queue + self.buffer
+            self.retry_queue, self.buffer = [], []
+            if not entries:
+                return True
+            try:
+                self.write_requests += 1
+                response = await asyncio.to_thread(
+                    self.sheet.append_rows, [row for row, _ in entries], value_input_option='RAW'
+                )
+            except Exception as e:
+                print(f"Gagal menulis {len(entries)} baris ke spreadsheet, masuk antrean retry: {e}")
+                self.retry_queue = entries
+                return False
+        if self.on_written is not None:
+            self.on_written([context for _, context in entries], self._first_row(response))
+        return True
+
+    @staticmethod
+    def _first_row(response) -> Optional[int]:
+        """Nomor baris awal dari updatedRange respons append (mis. 'Sheet1'!A5:M7 -> 5)."""
+        updated_range = (response or {}).get('updates', {}).get('updatedRange', '')
+        match = re.search(r'![A-Z]+(\d+)', updated_range)
+        return int(match.group(1)) if match else None
+
+    async def close(self):
+        """Flush terakhir di akhir run, dengan retry + backoff untuk baris yang masih gagal."""
+        if self.timer_task is not None:
+            self.timer_task.cancel()
+            self.timer_task = None
+        for attempt in range(self.max_retries + 1):
+            if await self.flush():
+                return
+            if attempt < self.max_retries:
+                await asyncio.sleep(random.uniform(0, min(30.0, 2.0 * (2 ** attempt))))
+        failed, self.retry_queue = self.retry_queue, []
+        print(f"{len(failed)} baris gagal ditulis ke spreadsheet setelah {self.max_retries} retry")
+        if self.on_failed is not None:
+            self.on_failed([context for _, context in failed])
+
+# ==============================================================================
+# UPLOAD DRIVE (DEDUP & BATCH PERMISSION)
+# ==============================================================================
+class DriveUploader:
+    """
+    Upload CV ke Drive untuk satu run. PDF dengan hash isi yang sama memakai ulang file yang
+    sudah ada (lintas posisi, per akun), sehingga tidak ada salinan baru setiap kali di-screening.
+    Permission 'anyone with link' tidak dibuat per file, tetapi dikumpulkan lalu dikirim lewat
+    batch request setiap batch_size file dan sekali lagi di close().
+    """
+
+    def __init__(self, drive, creds: Credentials, batch_size: int = DRIVE_PERMISSION_BATCH_SIZE):
+        self.drive = drive
+        self.creds = creds
+        self.owner = account_key(creds)
+        self.batch_size = batch_size
+        self.pending_shares = []
+        self.links = {}
+        self.lock = asyncio.Lock()
+
+    def _file_exists(self, file_id: str) -> bool:
+        try:
+            file = self.drive.files().get(fileId=file_id, fields='id, trashed').execute(
+                http=get_thread_http(self.creds)
+            )
+            return not file.get('trashed')
+        except HttpError as e:
+            if e.resp.status in (403, 404):
+                return False
+            raise
+
+    async def get_link(self, file_data: bytes, filename: str, content_hash: str) -> Optional[str]:
+        """
+        Link Drive untuk PDF ini; upload hanya jika belum ada file dengan hash isi yang sama.
+        Permintaan bersamaan untuk hash yang sama (mis. dari pipeline posisi lain) menunggu satu upload.
+        """
+        task = self.links.get(content_hash)
+        if task is None:
+            task = self.links[content_hash] = asyncio.ensure_future(
+                self._get_link(file_data, filename, content_hash)
+            )
+        return await asyncio.shield(task)
+
+    async def _get_link(self, file_data: bytes, filename: str, content_hash: str) -> Optional[str]:
+        try:
+            existing = await asyncio.to_thread(lookup_drive_file, self.owner, content_hash)
+            if existing is not None:
+                file_id, shared = existing
+                if await asyncio.to_thread(self._file_exists, file_id):
+                    if not shared:
+                        await self._share(file_id)
+                    return drive_file_link(file_id)
+                await asyncio.to_thread(forget_drive_file, self.owner, content_hash)
+        except Exception as e:
+            print(f"Gagal memeriksa file Drive yang sudah ada untuk {filename}: {e}")
+
+        file_id = await asyncio.to_thread(
+            lambda: upload_to_drive(self.drive, file_data, filename, http=get_thread_http(self.creds))
+        )
+        if not file_id:
+            return None
+        await asyncio.to_thread(store_drive_file, self.owner, content_hash, file_id)
+        await self._share(file_id)
+        return drive_file_link(file_id)
+
+    async def _share(self, file_id: str):
+        self.pending_shares.append(file_id)
+        if len(self.pending_shares) >= self.batch_size:
+            await self.flush()
+
+    async def flush(self):
+        async with self.lock:
+            file_ids, self.pending_shares = self.pending_shares, []
+            if not file_ids:
+                return
+            requests = [
+                (file_id, self.drive.permissions().create(
+                    fileId=file_id, body={'role': 'reader', 'type': 'anyone'}, fields='id'
+                ))
+                for file_id in file_ids
+            ]
+            try:
+                responses, errors = await asyncio.to_thread(
+                    lambda: execute_batch(self.drive, requests, self.batch_size, http=get_thread_http(self.creds))
+                )
+            except Exception as e:
+                print(f"Gagal membuat permission Drive untuk {len(file_ids)} file: {e}")
+                return
+            for file_id, error in errors.items():
+                print(f"Gagal membuat permission Drive untuk file {file_id}: {error}")
+            await asyncio.to_thread(mark_drive_files_shared, self.owner, list(responses))
+
+    async def close(self):
+        await self.flush()
+
+# ==============================================================================
+# PRE-FILTER LOKAL (TF-IDF)
+# ==============================================================================
+def tfidf_scores(job_desc: str, resume_texts: List[str], corpus=None):
+    """
+    Cosine similarity TF-IDF (tf sublinear, idf smooth) setiap resume terhadap deskripsi
+    pekerjaan. IDF dihitung dari deskripsi pekerjaan + `corpus` (jumlah dokumen, document
+    frequency per term dari update_prefilter_corpus), atau dari resume yang diberikan saja jika
+    corpus None. Vektor disimpan sparse (id term + bobot) sehingga memori sebanding dengan
+    jumlah term unik per dokumen, bukan dokumen x kosakata.
+    """
+    documents = [job_desc] + resume_texts
+    vocabulary = {}
+    term_ids, term_counts = [], []
+    for text in documents:
+        tokens = [vocabulary.setdefault(token, len(vocabulary)) for token in PREFILTER_TOKEN_PATTERN.findall(text.lower())]
+        ids, counts = np.unique(np.asarray(tokens, dtype=np.int64), return_counts=True)
+        term_ids.append(ids)
+        term_counts.append(counts)
+
+    lengths = np.array([len(ids) for ids in term_ids])
+    ids = np.concatenate(term_ids)
+    counts = np.concatenate(term_counts)
+    doc_index = np.repeat(np.arange(len(documents)), lengths)
+
+    if corpus is None:
+        document_count = len(documents)
+        document_frequency = np.bincount(ids, minlength=len(vocabulary))
+    else:
+        corpus_documents, corpus_frequency = corpus
+        document_count = corpus_documents + 1
+        document_frequency = np.array([corpus_frequency.get(term, 0) for term in vocabulary], dtype=np.float64)
+        document_frequency[term_ids[0]] += 1
+    idf = np.log((1 + document_count) / (1 + document_frequency)) + 1
+    weights = (1 + np.log(counts)) * idf[ids]
+    norms = np.sqrt(np.bincount(doc_index, weights=weights ** 2, minlength=len(documents)))
+
+    query = np.zeros(len(vocabulary))
+    query[term_ids[0]] = weights[:lengths[0]]
+    dots = np.bincount(doc_index, weights=weights * query[ids], minlength=len(documents))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scores = dots / (norms * norms[0])
+    return np.nan_to_num(scores[1:])
+
+def select_prefiltered(scores, top_k: int = PREFILTER_TOP_K, min_score: float = PREFILTER_MIN_SCORE):
+    """Index resume yang lolos pre-filter, urut dari skor tertinggi."""
+    selected = np.argsort(-scores, kind='stable')
+    if min_score > 0:
+        selected = selected[scores[selected] >= min_score]
+    if top_k > 0:
+        selected = selected[:top_k]
+    return selected
+
+# ==============================================================================
+# INGEST BERSAMA (SCREENING MULTI POSISI)
+# ==============================================================================
+class SharedIngest:
+    """
+    Tahap fetch & extract yang dipakai bersama oleh pipeline beberapa posisi dalam satu run.
+    Metadata email, isi lampiran, dan teks PDF masing-masing diambil/diekstrak sekali; pipeline
+    lain yang meminta data yang sama menunggu hasil yang sudah atau sedang berjalan. Upload Drive
+    memakai satu DriveUploader. Semua data hanya disimpan di memori selama run berlangsung.
+    """
+
+    def __init__(self, gmail, drive, creds: Credentials):
+        self.gmail = gmail
+        self.creds = creds
+        self.drive_uploader = DriveUploader(drive, creds)
+        self.messages = {}
+        self.attachments = {}
+        self.extractions = {}
+        self.stats = {'messages_fetched': 0, 'attachments_fetched': 0, 'pdfs_extracted': 0}
+
+    async def _load(self, cache: dict, keys: list, fetch) -> dict:
+        """
+        Nilai untuk setiap key; key yang belum ada di cache diambil dengan satu panggilan
+        fetch(missing_keys) -> dict (key yang tidak ada di hasil berarti gagal, nilainya None).
+        Jika fetch melempar exception, key-nya dibuang dari cache agar bisa dicoba lagi.
+        """
+        missing = [key for key in dict.fromkeys(keys) if key not in cache]
+        if missing:
+            task = asyncio.ensure_future(fetch(missing))
+            for key in missing:
+                cache[key] = task
+
+            def forget_failed(task):
+                if task.cancelled() or task.exception() is not None:
+                    for key in missing:
+                        if cache.get(key) is task:
+                            del cache[key]
+
+            task.add_done_callback(forget_failed)
+        return {key: (await asyncio.shield(cache[key])).get(key) for key in keys}
+
+    async def fetch_pdf_parts(self, message_ids: List[str], min_internal_date: int = 0):
+        """Seperti fetch_pdf_parts, tetapi metadata setiap email hanya diambil sekali per run."""
+        messages = await self._load(self.messages, message_ids, self._fetch_messages)
+        failed_message_ids = {message_id for message_id, message in messages.items() if message is None}
+        pdf_parts, message_dates = select_pdf_parts(
+            {message_id: message for message_id, message in messages.items() if message is not None},
+            message_ids, min_internal_date
+        )
+        return pdf_parts, message_dates, failed_message_ids
+
+    async def _fetch_messages(self, message_ids: List[str]) -> dict:
+        self.stats['messages_fetched'] += len(message_ids)
+        messages, _ = await asyncio.to_thread(
+            lambda: fetch_message_parts(self.gmail, message_ids, http=get_thread_http(self.creds))
+        )
+        return messages
+
+    async def fetch_attachments(self, pdf_parts):
+        """Seperti fetch_pdf_attachments, tetapi setiap lampiran hanya diunduh sekali per run."""
+        parts = {attachment_index_key(message_id, part): (message_id, part) for message_id, part in pdf_parts}
+
+        async def fetch(keys):
+            self.stats['attachments_fetched'] += len(keys)
+            fetched, _ = await asyncio.to_thread(
+                lambda: fetch_pdf_attachments(self.gmail, [parts[key] for key in keys], http=get_thread_http(self.creds))
+            )
+            return {attachment_index_key(message_id, part): file_data for message_id, part, file_data in fetched}
+
+        data = await self._load(self.attachments, list(parts), fetch)
+        fetched = [(message_id, part, data[key]) for key, (message_id, part) in parts.items() if data[key] is not None]
+        failed_message_ids = {message_id for key, (message_id, _) in parts.items() if data[key] is None}
+        return fetched, failed_message_ids
+
+    async def extract(self, content_hash: str, file_data: bytes) -> dict:
+        """Seperti extract_pdf_text_async, tetapi setiap PDF (per hash isi) hanya diekstrak sekali per run."""
+        async def fetch(keys):
+            self.stats['pdfs_extracted'] += 1
+            return {content_hash: await extract_pdf_text_async(file_data)}
+
+        return (await self._load(self.extractions, [content_hash], fetch))[content_hash]
+
+    async def close(self):
+        await self.drive_uploader.close()
+
+# ==============================================================================
+# PIPELINE SCREENING
+# ==============================================================================
+async def run_screening_pipeline(creds, gmail, drive, sheet, spreadsheet_name: str, message_ids: List[str],
+                                 analyzer: JobAnalyzer, existing_hashes: set, min_internal_date: int = 0,
+                                 on_progress=None, ingest: Optional[SharedIngest] = None):
+    """
+    Memproses email lamaran secara bertahap: fetch -> extract -> analyze -> persist.
+
+    Setiap lampiran PDF dari email dengan internalDate > min_internal_date menjadi item di
+    antrean kerja SQLite dan berjalan sebagai coroutine sendiri; panggilan blocking dijalankan
+    di thread worker dan dibatasi semaphore per tahap, baris hasil ditulis bulk lewat SheetWriter.
+    Jika `ingest` diberikan (screening multi posisi), pengambilan email, unduhan, ekstraksi, dan
+    upload Drive dibagi dengan posisi lain. Ringkasan hasil berisi `next_cursor` untuk cursor Gmail.
+    """
+    fetch_sem = asyncio.Semaphore(FETCH_CONCURRENCY)
+    extract_sem = asyncio.Semaphore(EXTRACT_CONCURRENCY)
+    analyze_sem = asyncio.Semaphore(ANALYZE_CONCURRENCY)
+    batcher = AnalysisBatcher(analyzer) if GEMINI_BATCH_SIZE > 1 else None
+
+    processed_results = []
+    stats = {'processed': 0, 'skipped': 0, 'filtered': 0}
+    extraction_stats = {}
+    failed_message_ids = set()
+
+    spreadsheet_id = sheet.spreadsheet.id
+    # State lokal (antrean, index, cursor) dikunci per akun: nama spreadsheet hanya unik per akun
+    owner = account_key(creds)
+    # Baris lama hanya bisa dicocokkan dengan hash teks pdfplumber; selama masih ada, CV yang
+    # tidak cocok dengan hash baru dicek juga dengan hash format lama
+    check_legacy_hashes = has_legacy_cv_hashes(existing_hashes)
+
+    # Event progress: `attachments` (jumlah lampiran yang akan diproses), lalu satu event
+    # `processed`, `skipped`, `filtered`, atau `failed` per lampiran
+    def report(event: str, **data):
+        if on_progress is not None:
+            on_progress({'event': event, **data})
+
+    def fail(item, reason: str, retry_blocks_cursor: bool = True):
+        """
+        Kegagalan item dicatat di antrean (state tetap di tahap terakhir yang berhasil). Email
+        dari run ini menahan cursor selama item masih akan dicoba lagi; item lama dari antrean
+        tidak perlu, karena antrean sendiri yang menyimpannya untuk run berikutnya.
+        """
+        fail_work_item(owner, spreadsheet_name, item, reason)
+        if item['attempts'] >= WORK_MAX_ATTEMPTS:
+            print(f"{item['part'].get('filename', '')} dilewati setelah {item['attempts']} percobaan: {reason}")
+        elif retry_blocks_cursor and item['message_id'] in message_dates:
+            failed_message_ids.add(item['message_id'])
+        report('failed', filename=item['part'].get('filename', ''), reason=reason)
+
+    def skip(item):
+        mark_attachment_processed(owner, spreadsheet_name, item['message_id'], item['part'], item['content_hash'])
+        finish_work_item(owner, spreadsheet_name, item, state='skipped')
+        stats['skipped'] += 1
+        report('skipped', filename=item['part'].get('filename', ''))
+
+    def filter_out(item, score: float):
+        # Tidak ditandai selesai: teks dan PDF-nya disimpan agar dinilai ulang di run berikutnya
+        update_work_item(owner, spreadsheet_name, item, state='filtered')
+        stats['filtered'] += 1
+        report('filtered', filename=item['part'].get('filename', ''), score=score)
+
+    def on_rows_written(contexts, first_row):
+        if first_row is not None:
+            append_results_mirror(spreadsheet_id, first_row, [context['result'] for context in contexts])
+        for context in contexts:
+            item = context['item']
+            mark_attachment_processed(owner, spreadsheet_name, item['message_id'], item['part'], item['content_hash'])
+            finish_work_item(owner, spreadsheet_name, item)
+            processed_results.append(context['result'])
+            stats['processed'] += 1
+            print(f"Berhasil proses: {item['part'].get('filename', '')}")
+            report('processed', filename=item['part'].get('filename', ''), result=context['result'])
+
+    def on_rows_failed(contexts):
+        for context in contexts:
+            existing_hashes.discard(context['item']['cv_hash'])
+            release_near_duplicate(owner, spreadsheet_name, context['item'])
+            fail(context['item'], 'Gagal menulis ke spreadsheet')
+
+    writer = SheetWriter(sheet, on_written=on_rows_written, on_failed=on_rows_failed)
+    drive_uploader = ingest.drive_uploader if ingest is not None else DriveUploader(drive, creds)
+
+    async def legacy_cv_hash(item, filename: str, resume_text: str, file_data: bytes) -> Optional[str]:
+        """CV_Hash format lama; teks pdfplumber diekstrak ulang (cukup 1000 karakter) jika perlu."""
+        if item.get('backend') == 'pdfplumber':
+            return create_legacy_cv_hash(filename, resume_text)
+        async with extract_sem:
+            extraction = await extract_pdf_text_async(file_data, max_chars=1000, backends=['pdfplumber'])
+        return create_legacy_cv_hash(filename, extraction['text']) if extraction['text'] else None
+
+    async def process_item(item, file_data: Optional[bytes] = None, analyze: bool = True):
+        """
+        Menjalankan tahap yang belum selesai untuk satu item antrean:
+        pending -> fetched -> extracted -> analyzed -> written. Hasil setiap tahap disimpan
+        sehingga item yang gagal atau terputus dilanjutkan dari tahap terakhirnya.
+        analyze=False berhenti di 'extracted' (menunggu pre-filter).
+        """
+        filename = item['part'].get('filename', '')
+        try:
+            if item['state'] == 'pending':
+                content_hash = hashlib.sha256(file_data).hexdigest()
+                item['content_hash'] = content_hash
+                if await asyncio.to_thread(is_content_indexed, owner, spreadsheet_name, content_hash):
+                    print(f"CV {filename} sudah pernah diproses (hash file sama), skip.")
+                    await asyncio.to_thread(skip, item)
+                    return
+                await asyncio.to_thread(save_work_blob, content_hash, file_data)
+                await asyncio.to_thread(update_work_item, owner, spreadsheet_name, item, state='fetched', content_hash=content_hash)
+
+            if item['state'] in ('fetched', 'extracted') and file_data is None:
+                file_data = await asyncio.to_thread(load_work_blob, item['content_hash'])
+                if file_data is None:
+                    await asyncio.to_thread(update_work_item, owner, spreadsheet_name, item, state='pending')
+                    fail(item, 'File PDF lokal tidak ditemukan, lampiran akan diunduh ulang')
+                    return
+
+            if item['state'] == 'fetched':
+                async with extract_sem:
+                    if ingest is not None:
+                        extraction = await ingest.extract(item['content_hash'], file_data)
+                    else:
+                        extraction = await extract_pdf_text_async(file_data)
+                add_extraction_stats(extraction_stats, extraction)
+                item['backend'] = extraction['backend']
+                print(f"Ekstraksi {filename}: {extraction['backend'] or 'gagal'} ({extraction['elapsed_ms']} ms)")
+
+                if not extraction['text']:
+                    print(f"Gagal ekstrak teks dari {filename}")
+                    fail(item, 'Gagal ekstrak teks dari PDF', retry_blocks_cursor=False)
+                    return
+                await asyncio.to_thread(
+                    update_work_item, owner, spreadsheet_name, item, state='extracted', resume_text=extraction['text']
+                )
+
+            if item['state'] == 'extracted' and not analyze:
+                return
+
+            if item['state'] == 'extracted':
+                resume_text = item['resume_text']
+                # Buat hash untuk CV ini
+                cv_hash = create_cv_hash(filename, resume_text)
+
+                # Periksa apakah CV sudah pernah diproses (termasuk yang sedang diproses coroutine lain);
+                # hash langsung dicatat sebelum await berikutnya agar coroutine lain ikut melihatnya
+                if cv_hash in existing_hashes:
+                    print(f"CV {filename} sudah pernah diproses, skip.")
+                    await asyncio.to_thread(skip, item)
+                    return
+                existing_hashes.add(cv_hash)
+
+                try:
+                    if check_legacy_hashes and await legacy_cv_hash(item, filename, resume_text, file_data) in existing_hashes:
+                        print(f"CV {filename} sudah pernah diproses (CV_Hash format lama), skip.")
+                        existing_hashes.discard(cv_hash)
+                        await asyncio.to_thread(skip, item)
+                        return
+
+                    # CV yang sama dengan nama file lain atau sedikit berubah (MinHash/LSH), sebelum upload & analisis
+                    near_duplicate = await asyncio.to_thread(
+                        claim_near_duplicate, owner, spreadsheet_name, item, resume_text
+                    )
+                    if near_duplicate is not None:
+                        print(f"CV {filename} hampir sama dengan CV yang sudah diproses, skip.")
+                        existing_hashes.discard(cv_hash)
+                        await asyncio.to_thread(skip, item)
+                        return
+
+                    # Upload ke Google Drive berjalan bersamaan dengan analisis Gemini
+                    async with analyze_sem:
+                        drive_link, analysis_result = await asyncio.gather(
+                            drive_uploader.get_link(file_data, filename, item['content_hash']),
+                            analyze_with_gemini(analyzer, resume_text, batcher)
+                        )
+                    if not drive_link:
+                        drive_link = "Gagal upload ke Drive"
+
+                    if not analysis_result:
+                        print(f"Gagal analisis {filename}")
+                        existing_hashes.discard(cv_hash)
+                        await asyncio.to_thread(release_near_duplicate, owner, spreadsheet_name, item)
+                        fail(item, 'Gagal analisis')
+                        return
+                    await asyncio.to_thread(
+                        update_work_item, owner, spreadsheet_name, item, state='analyzed',
+                        cv_hash=cv_hash, drive_link=drive_link, analysis=analysis_result
+                    )
+                except Exception:
+                    existing_hashes.discard(cv_hash)
+                    await asyncio.to_thread(release_near_duplicate, owner, spreadsheet_name, item)
+                    raise
+            elif item['cv_hash'] in existing_hashes:
+                # Item 'analyzed' dari run sebelumnya yang barisnya ternyata sudah tertulis
+                await asyncio.to_thread(skip, item)
+                return
+            else:
+                existing_hashes.add(item['cv_hash'])
+
+            analysis_result = item['analysis']
+            drive_link = item['drive_link']
+            current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            row_to_insert = [
+                current_time,
+                drive_link,
+                analysis_result.get('nama', 'Tidak tercantum'),
+                analysis_result.get('email', 'Tidak tercantum'),
+                analysis_result.get('nomor_telepon', 'Tidak tercantum'),
+                analysis_result.get('pendidikan_terakhir', 'Tidak tercantum'),
+                analysis_result.get('kekuatan', 'Tidak dapat dianalisis'),
+                analysis_result.get('kekurangan', 'Tidak dapat dianalisis'),
+                analysis_result.get('risk_factor', 'Tidak dapat dianalisis'),
+                analysis_result.get('reward_factor', 'Tidak dapat dianalisis'),
+                analysis_result.get('overall_fit', 0),
+                analysis_result.get('justifikasi', 'Tidak dapat dianalisis'),
+                item['cv_hash']  # Tambahkan hash sebagai kolom terakhir
+            ]
+
+            await writer.add(row_to_insert, {
+                'item': item,
+                'result': {
+                    "Waktu": current_time,
+                    "Drive Link": drive_link,
+                    "Nama": analysis_result.get('nama', 'Tidak tercantum'),
+                    "Email": analysis_result.get('email', 'Tidak tercantum'),
+                    "Nomor Telepon": analysis_result.get('nomor_telepon', 'Tidak tercantum'),
+                    "Pendidikan Terakhir": analysis_result.get('pendidikan_terakhir', 'Tidak tercantum'),
+                    "Kekuatan": analysis_result.get('kekuatan', 'Tidak dapat dianalisis'),
+                    "Kekurangan": analysis_result.get('kekurangan', 'Tidak dapat dianalisis'),
+                    "Risk Factor": analysis_result.get('risk_factor', 'Tidak dapat dianalisis'),
+                    "Reward Factor": analysis_result.get('reward_factor', 'Tidak dapat dianalisis'),
+                    "Overall Fit": analysis_result.get('overall_fit', 0),
+                    "Justifikasi": analysis_result.get('justifikasi', 'Tidak dapat dianalisis')
+                }
+            })
+
+        except Exception as e:
+            print(f"Error processing attachment {filename}: {e}")
+            fail(item, str(e))
+
+    async def fetch_and_process_batch(items, analyze: bool = True):
+        pdf_parts = [(item['message_id'], item['part']) for item in items]
+        try:
+            async with fetch_sem:
+                if ingest is not None:
+                    fetched, _ = await ingest.fetch_attachments(pdf_parts)
+                else:
+                    fetched, _ = await asyncio.to_thread(
+                        lambda: fetch_pdf_attachments(gmail, pdf_parts, http=get_thread_http(creds))
+                    )
+        except Exception as e:
+            print(f"Error fetching attachment batch: {e}")
+            for item in items:
+                fail(item, str(e))
+            return
+        fetched_data = {attachment_index_key(message_id, part): file_data for message_id, part, file_data in fetched}
+        tasks = []
+        for item in items:
+            file_data = fetched_data.get(attachment_index_key(item['message_id'], item['part']))
+            if file_data is None:
+                fail(item, 'Gagal mengunduh lampiran')
+            else:
+                tasks.append(process_item(item, file_data, analyze))
+        await asyncio.gather(*tasks)
+
+    async def prefilter(items) -> list:
+        """
+        Item yang lolos pre-filter, dipilih dari item 'extracted' run ini ditambah item yang
+        tertunda di run sebelumnya. Item baru yang tidak lolos dicatat sebagai filtered.
+        """
+        candidates = [item for item in items if item['state'] == 'extracted']
+        pool = candidates + await asyncio.to_thread(load_filtered_work_items, owner, spreadsheet_name)
+        if not pool:
+            return []
+        corpus = await asyncio.to_thread(
+            update_prefilter_corpus, owner, spreadsheet_name,
+            [(item['content_hash'], item['resume_text']) for item in pool], analyzer.job_desc
+        )
+        scores = await asyncio.to_thread(
+            tfidf_scores, analyzer.job_desc, [item['resume_text'] for item in pool], corpus
+        )
+        selected = set(select_prefiltered(scores).tolist())
+        print(f"Pre-filter: {len(selected)} dari {len(pool)} resume dilanjutkan ke analisis Gemini")
+        for index, item in enumerate(pool):
+            if index in selected and item['state'] == 'filtered':
+                await asyncio.to_thread(update_work_item, owner, spreadsheet_name, item, state='extracted')
+            elif index not in selected and item['state'] == 'extracted':
+                await asyncio.to_thread(filter_out, item, round(float(scores[index]), 4))
+        return [item for index, item in enumerate(pool) if index in selected]
+
+    async with fetch_sem:
+        if ingest is not None:
+            pdf_parts, message_dates, failed = await ingest.fetch_pdf_parts(message_ids, min_internal_date)
+        else:
+            pdf_parts, message_dates, failed = await asyncio.to_thread(
+                lambda: fetch_pdf_parts(gmail, message_ids, min_internal_date, http=get_thread_http(creds))
+            )
+    failed_message_ids.update(failed)
+
+    # Lampiran yang sudah tercatat di index (message/part/size) dilewati sebelum diunduh
+    pdf_parts, indexed_count = await asyncio.to_thread(filter_indexed_attachments, owner, spreadsheet_name, pdf_parts)
+    stats['skipped'] += indexed_count
+
+    # Lampiran baru masuk antrean kerja; antrean juga berisi item run sebelumnya yang belum selesai,
+    # yang dilanjutkan dari tahap terakhir yang berhasil sampai WORK_MAX_ATTEMPTS percobaan
+    await asyncio.to_thread(enqueue_work_items, owner, spreadsheet_name, pdf_parts)
+    items = await asyncio.to_thread(load_work_items, owner, spreadsheet_name)
+    listed_keys = {attachment_index_key(message_id, part) for message_id, part in pdf_parts}
+    resumed_count = sum(
+        1 for item in items
+        if item['state'] != 'pending' or item['attempts']
+        or attachment_index_key(item['message_id'], item['part']) not in listed_keys
+    )
+    report('attachments', total=len(items), already_indexed=indexed_count, resumed=resumed_count)
+
+    pending_items = [item for item in items if item['state'] == 'pending']
+    # Dengan PREFILTER_METHOD, semua item diekstrak dulu lalu diberi skor lokal terhadap deskripsi
+    # pekerjaan; hanya yang lolos select_prefiltered yang di-upload dan dianalisis Gemini
+    analyze = not PREFILTER_METHOD
+    try:
+        await asyncio.gather(
+            *(
+                fetch_and_process_batch(pending_items[start:start + GMAIL_ATTACHMENT_BATCH_SIZE], analyze)
+                for start in range(0, len(pending_items), GMAIL_ATTACHMENT_BATCH_SIZE)
+            ),
+            *(process_item(item, analyze=analyze) for item in items if item['state'] != 'pending')
+        )
+        if not analyze:
+            await asyncio.gather(*(process_item(item) for item in await prefilter(items)))
+    finally:
+        await writer.close()
+        if ingest is None:
+            await drive_uploader.close()
+
+    # Cursor hanya maju sampai sebelum email gagal tertua; jika tanggal email gagal tidak
+    # diketahui (metadata gagal diambil), cursor tidak dimajukan sama sekali.
+    next_cursor = min_internal_date
+    if all(message_id in message_dates for message_id in failed_message_ids):
+        failed_dates = [message_dates[message_id] for message_id in failed_message_ids]
+        oldest_failed = min(failed_dates, default=None)
+        done_dates = [
+            date for date in message_dates.values()
+            if oldest_failed is None or date < oldest_failed
+        ]
+        next_cursor = max(done_dates + [min_internal_date])
+
+    return {
+        "results": processed_results,
+        "processed_count": stats['processed'],
+        "skipped_count": stats['skipped'],
+        "filtered_count": stats['filtered'],
+        "new_emails": len(message_dates),
+        "failed_emails": len(failed_message_ids),
+        "extraction_stats": extraction_stats,
+        "sheet_write_requests": writer.write_requests,
+        "resumed_count": resumed_count,
+        "next_cursor": next_cursor
+    }
+
+# ==============================================================================
+# SESSION SCREENING (PER AKUN)
+# ==============================================================================
+class ScreeningSession:
+    """
+    Konfigurasi screening milik satu akun. Setiap posisi menyimpan subjek email dan
+    deskripsi pekerjaannya sendiri; `job_position_name` adalah posisi yang sedang aktif.
+    Deskripsi yang di-upload sebelum posisi diset disimpan di posisi kosong ("").
+    """
+
+    def __init__(self, owner: str, job_position_name: str = "", positions: Optional[dict] = None):
+        self.owner = owner
+        self.job_position_name = job_position_name
+        self.positions = positions or {}
+
+    def _position(self, name: str) -> dict:
+        return self.positions.setdefault(name, {'email_subjects': [], 'job_description_text': ''})
+
+    @property
+    def email_subjects(self) -> List[str]:
+        return self.positions.get(self.job_position_name, {}).get('email_subjects', [])
+
+    @property
+    def job_description_text(self) -> str:
+        return self.positions.get(self.job_position_name, {}).get('job_description_text', '')
+
+    def set_position(self, job_position_name: str, email_subjects: List[str]):
+        """Mengaktifkan posisi; posisi baru mewarisi deskripsi pekerjaan yang sedang aktif."""
+        current_job_description = self.job_description_text
+        position = self._position(job_position_name)
+        position['email_subjects'] = email_subjects
+        if not position['job_description_text']:
+            position['job_description_text'] = current_job_description
+        self.job_position_name = job_position_name
+
+    def set_job_description(self, job_description_text: str):
+        self._position(self.job_position_name)['job_description_text'] = job_description_text
+
+    def snapshot(self, job_position_name: Optional[str] = None) -> dict:
+        """
+        Salinan konfigurasi posisi aktif (atau posisi `job_position_name`); run screening
+        memakai salinan ini sampai selesai.
+        """
+        if job_position_name is None:
+            job_position_name = self.job_position_name
+        position = self.positions.get(job_position_name, {})
+        return {
+            'job_position_name': job_position_name,
+            'email_subjects': list(position.get('email_subjects', [])),
+            'job_description_text': position.get('job_description_text', ''),
+        }
+
+    def position_names(self) -> List[str]:
+        """Posisi yang sudah diset lewat /api/set-screening-config."""
+        return [name for name in self.positions if name]
+
+    def to_json(self) -> str:
+        return json.dumps({'job_position_name': self.job_position_name, 'positions': self.positions}, ensure_ascii=False)
+
+class SessionStore:
+    """Session per akun di memori, dengan salinan di SQLite jika backend 'sqlite'."""
+
+    def __init__(self, backend: str = SESSION_STORE_BACKEND):
+        self.persistent = backend == 'sqlite'
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def get(self, owner: str) -> ScreeningSession:
+        with self.lock:
+            session = self.sessions.get(owner)
+            if session is None:
+                session = self._load(owner) or ScreeningSession(owner)
+                self.sessions[owner] = session
+            return session
+
+    def save(self, session: ScreeningSession):
+        if not self.persistent:
+            return
+        with state_db() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO screening_sessions VALUES (?, ?, ?)",
+                (session.owner, session.to_json(), datetime.now().isoformat())
+            )
+
+    def _load(self, owner: str) -> Optional[ScreeningSession]:
+        if not self.persistent:
+            return None
+        with state_db() as conn:
+            row = conn.execute(
+                "SELECT data FROM screening_sessions WHERE account_key = ?", (owner,)
+            ).fetchone()
+        if row is None:
+            return None
+        data = json.loads(row[0])
+        return ScreeningSession(owner, data.get('job_position_name', ''), data.get('positions', {}))
+
+    def __len__(self):
+        return len(self.sessions)
+
+session_store = SessionStore()
+
+def get_session(request: Request):
+    """Kredensial dan session screening user yang sedang login (401 jika belum login)."""
+    creds = get_creds_from_cookie(request)
+    if not creds:
+        raise HTTPException(status_code=401, detail="User not authenticated")
+    return creds, session_store.get(account_key(creds))
+
+def current_spreadsheet_name(session: ScreeningSession) -> str:
+    # Jika tidak ada nama posisi yang diset, gunakan spreadsheet default
+    if not session.job_position_name:
+        return "Analisis Resume AI"
+    return generate_spreadsheet_name(session.job_position_name)
+
+# ==============================================================================
+# RUN SCREENING & JOB BACKGROUND
+# ==============================================================================
+def require_screening_config(config: dict):
+    """Validasi konfigurasi (snapshot session) sebelum screening dimulai."""
+    if not config['job_description_text']:
+        raise HTTPException(status_code=400, detail="Deskripsi pekerjaan belum di-upload.")
+    
+    if not config['job_position_name']:
+        raise HTTPException(status_code=400, detail="Nama posisi pekerjaan belum diset. Gunakan endpoint /api/set-screening-config terlebih dahulu.")
+    
+    if not config['email_subjects']:
+        raise HTTPException(status_code=400, detail="Subjek email belum diset. Gunakan endpoint /api/set-screening-config terlebih dahulu.")
+
+async def prepare_position_run(creds: Credentials, gmail, gc, config: dict) -> dict:
+    """
+    Menyiapkan run satu posisi: spreadsheet beserta header dan hash CV yang sudah ada,
+    query Gmail dan cursor-nya, lalu daftar ID email baru sejak cursor.
+    """
+    # Generate nama spreadsheet berdasarkan posisi pekerjaan
+    spreadsheet_name = generate_spreadsheet_name(config['job_position_name'])
+    spreadsheet = await asyncio.to_thread(ensure_spreadsheet_exists, gc, spreadsheet_name)
+    sheet = spreadsheet.sheet1
+    
+    # Pastikan headers termasuk CV_Hash ada
+    await asyncio.to_thread(ensure_headers_exist, sheet)
+    
+    # Dapatkan hash CV yang sudah ada
+    existing_hashes = await asyncio.to_thread(get_existing_hashes, sheet)
+    
+    # Build query berdasarkan subjek email yang diinput
+    gmail_query = build_gmail_query(config['email_subjects'])
+    print(f"Gmail query: {gmail_query}")
+    
+    # Cursor per posisi: hanya email yang masuk setelah run terakhir yang diambil
+    min_internal_date = await asyncio.to_thread(load_gmail_cursor, account_key(creds), spreadsheet_name, gmail_query)
+    list_query = gmail_query
+    if min_internal_date:
+        # Filter after: berbasis detik; email pada detik yang sama disaring lagi via internalDate
+        list_query = f"{gmail_query} after:{min_internal_date // 1000}"
+    
+    # Query Gmail untuk email dengan resume (semua halaman)
+    message_ids = await asyncio.to_thread(list_message_ids, gmail, list_query)
+    return {
+        'config': config,
+        'spreadsheet_name': spreadsheet_name,
+        'sheet': sheet,
+        'existing_hashes': existing_hashes,
+        'gmail_query': gmail_query,
+        'list_query': list_query,
+        'min_internal_date': min_internal_date,
+        'message_ids': message_ids
+    }
 
-def upload_to_drive(drive, file_data, filename):
-    """Upload file ke Google Drive dan return link"""
-    try:
-        # Buat file metadata
-        file_metadata = {
-            'name': f"CV_{filename}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.pdf",
-            'parents': []  # Bisa ditambahkan folder ID jika ingin simpan di folder tertentu
+async def complete_position_run(creds: Credentials, gmail, drive, run: dict, on_progress=None,
+                                ingest: Optional[SharedIngest] = None) -> dict:
+    """Menjalankan pipeline untuk run hasil prepare_position_run lalu memajukan cursor posisinya."""
+    spreadsheet_name = run['spreadsheet_name']
+    list_query = run['list_query']
+    min_internal_date = run['min_internal_date']
+    message_ids = run['message_ids']
+    # Tanpa email baru pipeline tetap dijalankan jika antrean berisi item yang perlu dicoba lagi
+    # (mis. gagal ekstrak atau timeout), agar item itu tidak menunggu email lain masuk
+    if not message_ids and not await asyncio.to_thread(has_pending_work_items, account_key(creds), spreadsheet_name):
+        return {
+            "message": "Tidak ada email baru dengan resume ditemukan untuk subjek yang ditentukan.", 
+            "results": [],
+            "spreadsheet_name": spreadsheet_name,
+            "gmail_query_used": list_query
         }
-        
-        # Upload file
-        media = io.BytesIO(file_data)
-        
-        # Import googleapiclient.http
-        from googleapiclient.http import MediaIoBaseUpload
-        media_upload = MediaIoBaseUpload(media, mimetype='application/pdf')
-        
-        file = drive.files().create(
-            body=file_metadata,
-            media_body=media_upload,
-            fields='id'
-        ).execute()
-        
-        file_id = file.get('id')
-        
-        # Set file permission menjadi readable
-        drive.permissions().create(
-            fileId=file_id,
-            body={'role': 'reader', 'type': 'anyone'}
-        ).execute()
-        
-        # Return Google Drive link
-        drive_link = f"https://drive.google.com/file/d/{file_id}/view"
-        return drive_link
-        
-    except Exception as e:
-        print(f"Error uploading to Drive: {e}")
-        return None
+    
+    analyzer = await asyncio.to_thread(get_job_analyzer, run['config']['job_description_text'])
+    summary = await run_screening_pipeline(
+        creds, gmail, drive, run['sheet'], spreadsheet_name, message_ids,
+        analyzer, run['existing_hashes'], min_internal_date, on_progress=on_progress, ingest=ingest
+    )
+    if summary["next_cursor"] > min_internal_date:
+        await asyncio.to_thread(
+            save_gmail_cursor, account_key(creds), spreadsheet_name, run['gmail_query'], summary["next_cursor"]
+        )
 
-def extract_text_from_pdf_bytes(pdf_bytes: bytes) -> str:
-    text = ""
-    try:
-        with pdfplumber.open(io.BytesIO(pdf_bytes)) as pdf:
-            for page in pdf.pages:
-                page_text = page.extract_text()
-                if page_text:
-                    text += page_text + "\n"
-    except Exception as e:
-        print(f"Gagal mengekstrak PDF: {e}")
-        return ""
-    return text.strip()
+    processed_count = summary["processed_count"]
+    skipped_count = summary["skipped_count"]
+    message = f"{processed_count} resume baru berhasil diproses, {skipped_count} resume sudah ada sebelumnya dari {len(message_ids)} email."
+    if summary["filtered_count"]:
+        message += f" {summary['filtered_count']} resume tidak lolos pre-filter."
+    
+    return {
+        "message": message, 
+        "results": summary["results"],
+        "processed_count": processed_count,
+        "skipped_count": skipped_count,
+        "filtered_count": summary["filtered_count"],
+        "failed_emails": summary["failed_emails"],
+        "extraction_stats": summary["extraction_stats"],
+        "sheet_write_requests": summary["sheet_write_requests"],
+        "total_emails": len(message_ids),
+        "spreadsheet_name": spreadsheet_name,
+        "gmail_query_used": list_query
+    }
+
+async def execute_screening_run(creds: Credentials, config: dict, on_progress=None) -> dict:
+    """
+    Satu run screening untuk konfigurasi `config` (snapshot session): menyiapkan spreadsheet,
+    mengambil email baru sejak cursor, menjalankan pipeline, lalu memajukan cursor. Return isi
+    respons /api/start-screening. on_progress diteruskan ke run_screening_pipeline, ditambah
+    event `emails` (jumlah email yang akan diperiksa).
+    """
+    gmail, drive, gc, _ = build_google_services(creds)
+    run = await prepare_position_run(creds, gmail, gc, config)
+    if on_progress is not None:
+        on_progress({'event': 'emails', 'total': len(run['message_ids'])})
+    return await complete_position_run(creds, gmail, drive, run, on_progress=on_progress)
 
-def analyze_with_gemini(job_desc: str, resume_text: str) -> dict:
+async def execute_multi_position_run(creds: Credentials, configs: List[dict], on_progress=None) -> dict:
+    """
+    Screening beberapa posisi dalam satu run. Email setiap posisi tetap didaftar dengan query dan
+    cursor posisi itu (hanya ID email), tetapi metadata email, unduhan lampiran, ekstraksi PDF, dan
+    upload Drive dijalankan sekali untuk semua posisi lewat SharedIngest. Setiap CV lalu dianalisis
+    dengan analyzer dan ditulis ke spreadsheet setiap posisi yang email-nya cocok.
+
+    Event progress pipeline diberi field `job_position`. Kegagalan satu posisi dicatat di
+    hasil posisi itu (`error`) tanpa menghentikan posisi lain.
+    """
+    gmail, drive, gc, _ = build_google_services(creds)
+    # Posisi yang gagal disiapkan (spreadsheet/Gmail error) tidak ikut ingest, tapi tetap dilaporkan
+    prepared = await asyncio.gather(
+        *(prepare_position_run(creds, gmail, gc, config) for config in configs),
+        return_exceptions=True
+    )
+    runs = [run for run in prepared if not isinstance(run, BaseException)]
+    message_ids = list(dict.fromkeys(message_id for run in runs for message_id in run['message_ids']))
+    if on_progress is not None:
+        on_progress({'event': 'emails', 'total': len(message_ids)})
+
+    def position_progress(job_position_name: str):
+        if on_progress is None:
+            return None
+        return lambda event: on_progress({**event, 'job_position': job_position_name})
+
+    ingest = SharedIngest(gmail, drive, creds)
     try:
-        model = genai.GenerativeModel('gemini-2.5-flash')
-        prompt = f"""
-        Sebagai seorang HR Specialist yang berpengalaman, analisis resume pelamar berikut dengan detail dan objektif berdasarkan deskripsi pekerjaan yang diberikan.
+        # Metadata semua email diambil sekali di depan; pipeline per posisi memakai hasilnya
+        await ingest.fetch_pdf_parts(message_ids)
+        outcomes = await asyncio.gather(
+            *(
+                complete_position_run(
+                    creds, gmail, drive, run,
+                    on_progress=position_progress(run['config']['job_position_name']), ingest=ingest
+                )
+                for run in runs
+            ),
+            return_exceptions=True
+        )
+    finally:
+        await ingest.close()
 
-        INSTRUKSI ANALISIS:
-        1. Baca resume dengan teliti dan ekstrak informasi penting
-        2. Bandingkan dengan requirements job description
-        3. Berikan penilaian yang objektif dan konstruktif
-        4. Fokus pada relevansi dan potensi kandidat
+    positions = []
+    run_outcomes = iter(outcomes)
+    for config, run in zip(configs, prepared):
+        job_position_name = config['job_position_name']
+        outcome = run if isinstance(run, BaseException) else next(run_outcomes)
+        if isinstance(outcome, BaseException):
+            print(f"Screening posisi {job_position_name} gagal: {outcome}")
+            outcome = {
+                "error": outcome.detail if isinstance(outcome, HTTPException) else str(outcome),
+                "results": [],
+                "spreadsheet_name": generate_spreadsheet_name(job_position_name)
+            }
+        positions.append({"job_position": job_position_name, **outcome})
 
-        FORMAT OUTPUT (JSON ONLY, NO MARKDOWN):
-        {{
-            "nama": "Nama lengkap pelamar (wajib diisi dari resume)",
-            "email": "Email pelamar jika tersedia, jika tidak ada tulis 'Tidak tercantum'",
-            "nomor_telepon": "Nomor telepon jika tersedia, jika tidak ada tulis 'Tidak tercantum', Gunakan format contoh +6289836718275",
-            "pendidikan_terakhir": "Jenjang dan jurusan pendidikan terakhir (Rubah Seluruhnya Gunakan bahasa indonesia dengan Format contoh: S1 Informatika)",
-            "kekuatan": "3-4 kekuatan utama kandidat yang relevan dengan posisi (maksimal 200 kata)",
-            "kekurangan": "Area yang perlu ditingkatkan atau gap yang ditemukan (maksimal 150 kata)",
-            "risk_factor": "Potensi risiko dalam merekrut kandidat ini (maksimal 150 kata)",
-            "reward_factor": "Potensi manfaat dan value yang akan dibawa kandidat (maksimal 150 kata)",
-            "overall_fit": 85,
-            "justifikasi": "Penjelasan detail mengapa memberikan score tersebut (maksimal 200 kata)"
-        }}
+    processed_count = sum(position.get("processed_count", 0) for position in positions)
+    skipped_count = sum(position.get("skipped_count", 0) for position in positions)
+    filtered_count = sum(position.get("filtered_count", 0) for position in positions)
+    return {
+        "message": f"{processed_count} resume baru berhasil diproses, {skipped_count} resume sudah ada sebelumnya dari {len(message_ids)} email untuk {len(positions)} posisi.",
+        "positions": positions,
+        "processed_count": processed_count,
+        "skipped_count": skipped_count,
+        "filtered_count": filtered_count,
+        "total_emails": len(message_ids),
+        "ingest_stats": ingest.stats
+    }
 
-        KRITERIA PENILAIAN:
-        - Overall Fit Score (0-100):
-          * 90-100: Sangat sesuai, kandidat ideal
-          * 80-89: Sesuai dengan sedikit gap
-          * 70-79: Cukup sesuai tapi ada beberapa kekurangan
-          * 60-69: Kurang sesuai, banyak gap
-          * <60: Tidak sesuai
+class ScreeningJob:
+    """
+    Run screening yang berjalan sebagai task asyncio di proses server. Event progress
+    disimpan berurutan (nomor urut = id event SSE) sehingga klien bisa menyambung ulang
+    stream dari event terakhir yang diterima.
+    """
 
-        DESKRIPSI PEKERJAAN:
-        {job_desc[:2000]}
+    def __init__(self, owner: str, spreadsheet_names: List[str]):
+        self.id = uuid.uuid4().hex
+        self.owner = owner
+        self.spreadsheet_names = spreadsheet_names
+        self.spreadsheet_name = ", ".join(spreadsheet_names)
+        self.status = 'queued'
+        self.created_at = datetime.now()
+        self.finished_at = None
+        self.events = []
+        self.progress = {
+            'total_emails': None, 'total_attachments': None,
+            'processed': 0, 'skipped': 0, 'filtered': 0, 'failed': 0
+        }
+        self.results = []
+        self.summary = None
+        self.error = None
+        self.task = None
+        self.changed = asyncio.Event()
 
-        RESUME PELAMAR:
-        {resume_text[:5000]}
+    @property
+    def finished(self) -> bool:
+        return self.status in ('completed', 'failed')
 
-        Berikan analisis yang profesional, jujur, dan membantu dalam proses seleksi.
-        """
-        
-        response = model.generate_content(prompt)
-        
-        # Bersihkan response text
-        cleaned_text = response.text.strip()
-        if cleaned_text.startswith('```json'):
-            cleaned_text = cleaned_text.replace('```json', '').replace('```', '').strip()
-        elif cleaned_text.startswith('```'):
-            cleaned_text = cleaned_text.replace('```', '').strip()
-        
-        # Parse JSON
-        result = json.loads(cleaned_text)
-        
-        # Validasi dan set default values
-        default_values = {
-            'nama': 'Tidak tercantum',
-            'email': 'Tidak tercantum',
-            'nomor_telepon': 'Tidak tercantum',
-            'pendidikan_terakhir': 'Tidak tercantum',
-            'kekuatan': 'Tidak dapat dianalisis',
-            'kekurangan': 'Tidak dapat dianalisis',
-            'risk_factor': 'Tidak dapat dianalisis',
-            'reward_factor': 'Tidak dapat dianalisis',
-            'overall_fit': 0,
-            'justifikasi': 'Tidak dapat dianalisis'
+    def publish(self, event: dict):
+        kind = event['event']
+        if kind == 'emails':
+            self.progress['total_emails'] = event['total']
+        elif kind == 'attachments':
+            # Run multi posisi mengirim satu event per posisi
+            self.progress['total_attachments'] = (self.progress['total_attachments'] or 0) + event['total']
+            self.progress['skipped'] += event.get('already_indexed', 0)
+        elif kind in ('processed', 'skipped', 'filtered', 'failed') and 'filename' in event:
+            self.progress[kind] += 1
+            if kind == 'processed':
+                result = event['result']
+                if 'job_position' in event:
+                    result = {**result, "Posisi": event['job_position']}
+                self.results.append(result)
+        self.events.append(event)
+        # Bangunkan semua stream yang menunggu, lalu siapkan Event baru untuk penantian berikutnya
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    def to_dict(self) -> dict:
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "spreadsheet_name": self.spreadsheet_name,
+            "spreadsheet_names": self.spreadsheet_names,
+            "created_at": self.created_at.isoformat(),
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+            "progress": self.progress,
+            "results": self.results,
+            "summary": self.summary,
+            "error": self.error
         }
-        
-        for field, default_value in default_values.items():
-            if field not in result or result[field] == '':
-                result[field] = default_value
-        
-        # Pastikan overall_fit adalah integer
-        if isinstance(result['overall_fit'], str):
-            try:
-                result['overall_fit'] = int(''.join(filter(str.isdigit, result['overall_fit']))) or 0
-            except:
-                result['overall_fit'] = 0
-        
-        return result
-        
-    except json.JSONDecodeError as e:
-        print(f"JSON parsing error: {e}")
-        print(f"Raw response: {response.text if 'response' in locals() else 'No response'}")
-        return None
-    except Exception as e:
-        print(f"Error dari Gemini API: {e}")
-        return None
 
-def create_cv_hash(filename, resume_text):
-    """Membuat hash unik berdasarkan filename dan isi CV untuk deteksi duplikasi"""
-    content = f"{filename}:{resume_text[:1000]}"  # Gunakan 1000 karakter pertama
-    return hashlib.md5(content.encode()).hexdigest()
+# Job hanya disimpan di memori proses ini. Di Vercel (serverless) proses dibekukan setelah
+# respons dikirim, sehingga mode job membutuhkan server yang berjalan terus (mis. uvicorn);
+# di sana /api/start-screening tetap menjadi mode yang didukung.
+screening_jobs = {}
+# Run sinkron (/api/start-screening*) yang sedang berjalan: run_id -> (owner, spreadsheet_names).
+# Ikut dicek bersama job agar satu antrean tidak diproses dua run sekaligus.
+running_screenings = {}
 
-def get_existing_hashes(sheet):
-    """Mengambil semua hash CV yang sudah ada di spreadsheet"""
+async def run_screening_job(job: ScreeningJob, run_screening):
+    """run_screening(on_progress=...) adalah execute_screening_run/execute_multi_position_run yang sudah diikat argumennya."""
+    job.status = 'running'
+    job.publish({'event': 'started', 'spreadsheet_name': job.spreadsheet_name})
     try:
-        all_records = sheet.get_all_records()
-        existing_hashes = set()
-        
-        for record in all_records:
-            cv_hash = record.get('CV_Hash', '')
-            if cv_hash:
-                existing_hashes.add(cv_hash)
-        
-        return existing_hashes
+        summary = await run_screening(on_progress=job.publish)
+        job.summary = {k: v for k, v in summary.items() if k != 'results'}
+        job.status = 'completed'
+        job.finished_at = datetime.now()
+        job.publish({'event': 'completed', 'summary': job.summary})
     except Exception as e:
-        print(f"Error getting existing hashes: {e}")
-        return set()
+        print(f"Job screening {job.id} gagal: {e}")
+        job.error = e.detail if isinstance(e, HTTPException) else str(e)
+        job.status = 'failed'
+        job.finished_at = datetime.now()
+        job.publish({'event': 'failed', 'error': job.error})
 
-def ensure_headers_exist(sheet):
-    """Memastikan header kolom termasuk CV_Hash ada di spreadsheet"""
+def prune_screening_jobs():
+    """Membuang job yang sudah selesai lebih dari SCREENING_JOB_RETENTION detik."""
+    now = datetime.now()
+    for job_id in [
+        job_id for job_id, job in screening_jobs.items()
+        if job.finished and (now - job.finished_at).total_seconds() > SCREENING_JOB_RETENTION
+    ]:
+        del screening_jobs[job_id]
+
+def get_screening_job(request: Request, job_id: str) -> ScreeningJob:
+    """Job milik user yang sedang login; job milik akun lain diperlakukan seperti tidak ada."""
+    creds = get_creds_from_cookie(request)
+    if not creds:
+        raise HTTPException(status_code=401, detail="User not authenticated")
+    job = screening_jobs.get(job_id)
+    if job is None or job.owner != account_key(creds):
+        raise HTTPException(status_code=404, detail="Job tidak ditemukan")
+    return job
+
+def spreadsheet_targets(owner: str, spreadsheet_names: List[str]) -> dict:
+    """
+    Kunci konflik per nama spreadsheet: nama milik akun itu sendiri, ditambah ID dari registry
+    jika sudah terdaftar, sehingga spreadsheet yang di-share ke beberapa akun tetap terdeteksi.
+    """
+    targets = {}
+    for spreadsheet_name in spreadsheet_names:
+        keys = {('name', owner, spreadsheet_name)}
+        spreadsheet_id = lookup_spreadsheet_id(owner, spreadsheet_name)
+        if spreadsheet_id:
+            keys.add(('id', spreadsheet_id))
+        targets[spreadsheet_name] = keys
+    return targets
+
+def check_screening_conflicts(owner: str, spreadsheet_names: List[str]):
+    """
+    409 jika salah satu spreadsheet sedang di-screening job atau run sinkron lain, termasuk
+    run akun lain yang menulis ke spreadsheet (ID) yang sama. Tidak ada await di dalamnya,
+    sehingga cek lalu pendaftaran run oleh pemanggil tidak bisa diselingi request lain.
+    """
+    prune_screening_jobs()
+    targets = spreadsheet_targets(owner, spreadsheet_names)
+    running = [(job.owner, job.spreadsheet_names, f" (job {job.id})") for job in screening_jobs.values() if not job.finished]
+    running += [(run_owner, run_names, "") for run_owner, run_names in running_screenings.values()]
+    for run_owner, run_names, label in running:
+        run_keys = set().union(*spreadsheet_targets(run_owner, run_names).values())
+        busy = [name for name, keys in targets.items() if keys & run_keys]
+        if busy and run_owner == owner:
+            raise HTTPException(status_code=409, detail=f"Screening untuk '{', '.join(sorted(busy))}' sedang berjalan{label}")
+        if busy:
+            raise HTTPException(status_code=409, detail=f"Spreadsheet '{', '.join(sorted(busy))}' sedang di-screening oleh akun lain")
+
+async def run_screening_now(owner: str, spreadsheet_names: List[str], run_screening) -> dict:
+    """Menjalankan screening sinkron setelah lolos cek konflik; run terdaftar selama berjalan."""
+    check_screening_conflicts(owner, spreadsheet_names)
+    run_id = uuid.uuid4().hex
+    running_screenings[run_id] = (owner, spreadsheet_names)
     try:
-        headers = sheet.row_values(1)
-        required_headers = [
-            'Waktu', 'Drive Link', 'Nama', 'Email', 'Nomor Telepon',
-            'Pendidikan Terakhir', 'Kekuatan', 'Kekurangan', 
-            'Risk Factor', 'Reward Factor', 'Overall Fit', 'Justifikasi', 'CV_Hash'
-        ]
-        
-        if not headers or len(headers) != len(required_headers):
-            sheet.clear()
-            sheet.append_row(required_headers)
-            print("Headers updated with new columns")
-            
-    except Exception as e:
-        print(f"Error ensuring headers: {e}")
+        return await run_screening()
+    finally:
+        del running_screenings[run_id]
 
-def build_gmail_query(email_subjects: List[str]) -> str:
-    """Membangun query Gmail berdasarkan subjek email yang diinput"""
-    if not email_subjects:
-        # Default query jika tidak ada subjek yang dispecified
-        return 'subject:cv OR subject:resume has:attachment filename:pdf'
-    
-    # Bangun query dengan OR untuk setiap subjek
-    subject_queries = []
-    for subject in email_subjects:
-        subject = subject.strip()
-        if subject:
-            # Escape special characters jika perlu
-            subject_queries.append(f'subject:{subject}')
+def launch_screening_job(owner: str, spreadsheet_names: List[str], run_screening) -> JSONResponse:
+    """Mendaftarkan dan menjalankan job; 409 jika bentrok dengan run lain (check_screening_conflicts)."""
+    check_screening_conflicts(owner, spreadsheet_names)
     
-    if not subject_queries:
-        return 'subject:cv OR subject:resume has:attachment filename:pdf'
+    job = ScreeningJob(owner, spreadsheet_names)
+    screening_jobs[job.id] = job
+    job.task = asyncio.create_task(run_screening_job(job, run_screening))
     
-    # Gabungkan semua subjek dengan OR dan tambahkan filter attachment
-    query = ' OR '.join(subject_queries) + ' has:attachment filename:pdf'
-    return query
+    return JSONResponse(status_code=202, content={
+        "job_id": job.id,
+        "status": job.status,
+        "spreadsheet_name": job.spreadsheet_name,
+        "status_url": f"/api/jobs/{job.id}",
+        "events_url": f"/api/jobs/{job.id}/events"
+    })
 
-def check_spreadsheet_exists(gc, spreadsheet_name: str) -> bool:
-    """Periksa apakah spreadsheet dengan nama tertentu sudah ada"""
-    try:
-        gc.open(spreadsheet_name)
-        return True
-    except gspread.exceptions.SpreadsheetNotFound:
-        return False
+def multi_position_configs(session: ScreeningSession, job_positions: List[str]) -> List[dict]:
+    """Snapshot posisi yang diminta (default semua posisi di session), sudah divalidasi."""
+    job_positions = [name.strip() for name in job_positions if name.strip()] or session.position_names()
+    if not job_positions:
+        raise HTTPException(status_code=400, detail="Belum ada posisi yang dikonfigurasi. Gunakan endpoint /api/set-screening-config terlebih dahulu.")
+    configs = []
+    for job_position_name in dict.fromkeys(job_positions):
+        if job_position_name not in session.positions:
+            raise HTTPException(status_code=400, detail=f"Posisi '{job_position_name}' belum dikonfigurasi.")
+        config = session.snapshot(job_position_name)
+        require_screening_config(config)
+        configs.append(config)
+    return configs
+
+async def stream_job_events(job: ScreeningJob, start: int):
+    """Server-Sent Events: kirim event mulai index `start`, lalu tunggu event baru sampai job selesai."""
+    index = start
+    while True:
+        waiter = job.changed
+        while index < len(job.events):
+            event = job.events[index]
+            yield f"id: {index}\nevent: {event['event']}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+            index += 1
+        if job.finished:
+            return
+        try:
+            await asyncio.wait_for(waiter.wait(), timeout=SSE_KEEPALIVE_INTERVAL)
+        except asyncio.TimeoutError:
+            yield ": keep-alive\n\n"
 
-def get_spreadsheet_url(gc, spreadsheet_name: str) -> str:
-    """Mendapatkan URL spreadsheet berdasarkan nama"""
-    try:
-        spreadsheet = gc.open(spreadsheet_name)
-        return f"https://docs.google.com/spreadsheets/d/{spreadsheet.id}/edit"
-    except gspread.exceptions.SpreadsheetNotFound:
-        return ""
 # ==============================================================================
 # ENDPOINTS API
 # ==============================================================================
+@app.middleware("http")
+async def reissue_auth_cookie(request: Request, call_next):
+    """Menulis ulang cookie auth_token jika access token di-refresh selama request."""
+    response = await call_next(request)
+    creds_dict = getattr(request.state, 'refreshed_auth_token', None)
+    if creds_dict:
+        set_auth_cookie(response, creds_dict)
+    return response
+
 @app.get("/")
 def root():
     return {"message": "AI Resume Screening API is running!"}
@@ -456,17 +3554,12 @@ async def auth_callback(request: Request):
         # --- PERUBAHAN UTAMA DI SINI ---
         credentials = flow.credentials
         creds_dict = credentials_to_dict(credentials)
+        # Identitas akun di-resolve sekarang agar request berikutnya tidak menunggu getProfile
+        await asyncio.to_thread(account_key, credentials)
         
         # Buat respons redirect dan atur cookie di dalamnya
         response = RedirectResponse(url=FRONTEND_URL)
-        response.set_cookie(
-            key="auth_token", 
-            value=json.dumps(creds_dict), 
-            httponly=True,       # Cookie tidak bisa diakses oleh JavaScript
-            secure=True,         # Hanya dikirim melalui HTTPS
-            samesite="Lax",      # Perlindungan CSRF
-            max_age=60*60*24*7   # Cookie berlaku selama 7 hari
-        )
+        set_auth_cookie(response, creds_dict)
         return response
         # -----------------------------
 
@@ -505,8 +3598,8 @@ async def get_auth_status(request: Request):
 
 @app.post("/api/set-screening-config")
 async def set_screening_config(config: ScreeningConfig, request: Request):
-    """Set konfigurasi screening: nama posisi dan subjek email"""
-    global job_position_name, email_subjects
+    """Set konfigurasi screening milik user yang login: nama posisi dan subjek email"""
+    creds, session = get_session(request)
     
     try:
         job_position_name = config.job_position.strip()
@@ -518,10 +3611,13 @@ async def set_screening_config(config: ScreeningConfig, request: Request):
         if not email_subjects:
             raise HTTPException(status_code=400, detail="Minimal satu subjek email harus diisi")
         
+        session.set_position(job_position_name, email_subjects)
+        await asyncio.to_thread(session_store.save, session)
+        
         # Coba dapatkan URL spreadsheet
         spreadsheet_url = ""
         try:
-            _, _, gc, _ = get_google_services(request=request)
+            _, _, gc, _ = build_google_services(creds)
             spreadsheet_name = generate_spreadsheet_name(job_position_name)
             spreadsheet_url = get_spreadsheet_url(gc, spreadsheet_name)
         except:
@@ -543,38 +3639,49 @@ async def set_screening_config(config: ScreeningConfig, request: Request):
 
 @app.get("/api/get-screening-config")
 async def get_screening_config(request: Request):
-    """Mendapatkan konfigurasi screening saat ini"""
+    """Mendapatkan konfigurasi screening user yang login (kosong jika belum login)"""
+    creds = get_creds_from_cookie(request)
+    session = session_store.get(account_key(creds)) if creds else ScreeningSession("")
+    job_position_name = session.job_position_name
+    
     spreadsheet_url = ""
-    if job_position_name and isLoggedIn:  # Hanya cek URL jika sudah login dan ada posisi
+    if job_position_name:  # Hanya cek URL jika sudah login dan ada posisi
         try:
-            _, _, gc, _ = get_google_services(request=request)
+            _, _, gc, _ = build_google_services(creds)
             spreadsheet_name = generate_spreadsheet_name(job_position_name)
             spreadsheet_url = get_spreadsheet_url(gc, spreadsheet_name)
         except:
-            pass  # Ignore error jika belum login atau spreadsheet belum ada
+            pass  # Ignore error jika spreadsheet belum ada
     
     return JSONResponse(content={
         "job_position": job_position_name,
-        "email_subjects": email_subjects,
+        "email_subjects": session.email_subjects,
         "spreadsheet_name": generate_spreadsheet_name(job_position_name) if job_position_name else "",
         "spreadsheet_url": spreadsheet_url,
-        "has_job_description": bool(job_description_text)
+        "has_job_description": bool(session.job_description_text)
     })
 
 @app.post("/api/upload-job-description")
-async def upload_job_description(file: UploadFile = File(...)):
-    global job_description_text
+async def upload_job_description(request: Request, file: UploadFile = File(...)):
+    _, session = get_session(request)
     
     try:
         if not file.filename.endswith('.pdf'):
             raise HTTPException(status_code=400, detail="File harus berformat PDF")
         
         pdf_bytes = await file.read()
-        job_description_text = extract_text_from_pdf_bytes(pdf_bytes)
+        extraction = await extract_pdf_text_async(pdf_bytes, max_chars=None, max_pages=None)
+        job_description_text = extraction['text']
         
         if not job_description_text:
             raise HTTPException(status_code=400, detail="Gagal mengekstrak teks dari PDF atau PDF kosong")
         
+        session.set_job_description(job_description_text)
+        await asyncio.to_thread(session_store.save, session)
+        
+        # Model Gemini dan prefix prompt per posisi disiapkan sekali di sini
+        await asyncio.to_thread(get_job_analyzer, job_description_text)
+        
         return {"message": "Deskripsi pekerjaan berhasil diekstrak.", "preview": job_description_text[:500] + "..."}
     
     except HTTPException as e:
@@ -585,157 +3692,15 @@ async def upload_job_description(file: UploadFile = File(...)):
 
 @app.post("/api/start-screening")
 async def start_screening(request: Request):
-    global job_description_text, job_position_name, email_subjects
-    
-    if not job_description_text:
-        raise HTTPException(status_code=400, detail="Deskripsi pekerjaan belum di-upload.")
-    
-    if not job_position_name:
-        raise HTTPException(status_code=400, detail="Nama posisi pekerjaan belum diset. Gunakan endpoint /api/set-screening-config terlebih dahulu.")
-    
-    if not email_subjects:
-        raise HTTPException(status_code=400, detail="Subjek email belum diset. Gunakan endpoint /api/set-screening-config terlebih dahulu.")
+    creds, session = get_session(request)
+    config = session.snapshot()
+    require_screening_config(config)
     
     try:
-        gmail, drive, gc, refreshed_creds = get_google_services(request=request)
-        
-        # Generate nama spreadsheet berdasarkan posisi pekerjaan
-        spreadsheet_name = generate_spreadsheet_name(job_position_name)
-        spreadsheet = ensure_spreadsheet_exists(gc, spreadsheet_name)
-        sheet = spreadsheet.sheet1
-        
-        # Pastikan headers termasuk CV_Hash ada
-        ensure_headers_exist(sheet)
-        
-        # Dapatkan hash CV yang sudah ada
-        existing_hashes = get_existing_hashes(sheet)
-        
-        # Build query berdasarkan subjek email yang diinput
-        gmail_query = build_gmail_query(email_subjects)
-        print(f"Gmail query: {gmail_query}")
-        
-        # Query Gmail untuk email dengan resume
-        results = gmail.users().messages().list(
-            userId='me', 
-            q=gmail_query
-        ).execute()
-        
-        messages = results.get('messages', [])
-        if not messages:
-            return JSONResponse(content={
-                "message": "Tidak ada email dengan resume ditemukan untuk subjek yang ditentukan.", 
-                "results": [],
-                "spreadsheet_name": spreadsheet_name,
-                "gmail_query_used": gmail_query
-            })
-        
-        processed_results = []
-        processed_count = 0
-        skipped_count = 0
-        
-        for message in messages[:50]:  # Proses maksimal 50 email untuk menghindari timeout
-            try:
-                msg = gmail.users().messages().get(userId='me', id=message['id']).execute()
-                
-                # Periksa apakah email memiliki attachments
-                payload = msg['payload']
-                parts = payload.get('parts', [])
-                if not parts:
-                    continue
-                
-                for part in parts:
-                    filename = part.get('filename', '')
-                    if filename and filename.lower().endswith('.pdf'):
-                        try:
-                            attachment_id = part['body']['attachmentId']
-                            attachment = gmail.users().messages().attachments().get(
-                                userId='me', 
-                                messageId=message['id'], 
-                                id=attachment_id
-                            ).execute()
-                            
-                            file_data = base64.urlsafe_b64decode(attachment['data'].encode('UTF-8'))
-                            resume_text = extract_text_from_pdf_bytes(file_data)
-                            
-                            if not resume_text:
-                                print(f"Gagal ekstrak teks dari {filename}")
-                                continue
-                            
-                            # Buat hash untuk CV ini
-                            cv_hash = create_cv_hash(filename, resume_text)
-                            
-                            # Periksa apakah CV sudah pernah diproses
-                            if cv_hash in existing_hashes:
-                                print(f"CV {filename} sudah pernah diproses, skip.")
-                                skipped_count += 1
-                                continue
-                            
-                            # Upload ke Google Drive
-                            drive_link = upload_to_drive(drive, file_data, filename)
-                            if not drive_link:
-                                drive_link = "Gagal upload ke Drive"
-                            
-                            analysis_result = analyze_with_gemini(job_description_text, resume_text)
-                            if not analysis_result:
-                                print(f"Gagal analisis {filename}")
-                                continue
-                            
-                            current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                            row_to_insert = [
-                                current_time,
-                                drive_link,
-                                analysis_result.get('nama', 'Tidak tercantum'),
-                                analysis_result.get('email', 'Tidak tercantum'),
-                                analysis_result.get('nomor_telepon', 'Tidak tercantum'),
-                                analysis_result.get('pendidikan_terakhir', 'Tidak tercantum'),
-                                analysis_result.get('kekuatan', 'Tidak dapat dianalisis'),
-                                analysis_result.get('kekurangan', 'Tidak dapat dianalisis'),
-                                analysis_result.get('risk_factor', 'Tidak dapat dianalisis'),
-                                analysis_result.get('reward_factor', 'Tidak dapat dianalisis'),
-                                analysis_result.get('overall_fit', 0),
-                                analysis_result.get('justifikasi', 'Tidak dapat dianalisis'),
-                                cv_hash  # Tambahkan hash sebagai kolom terakhir
-                            ]
-                            
-                            sheet.append_row(row_to_insert)
-                            existing_hashes.add(cv_hash)  # Tambahkan ke set agar tidak diproses lagi dalam sesi ini
-                            
-                            processed_results.append({
-                                "Waktu": current_time,
-                                "Drive Link": drive_link,
-                                "Nama": analysis_result.get('nama', 'Tidak tercantum'),
-                                "Email": analysis_result.get('email', 'Tidak tercantum'),
-                                "Nomor Telepon": analysis_result.get('nomor_telepon', 'Tidak tercantum'),
-                                "Pendidikan Terakhir": analysis_result.get('pendidikan_terakhir', 'Tidak tercantum'),
-                                "Kekuatan": analysis_result.get('kekuatan', 'Tidak dapat dianalisis'),
-                                "Kekurangan": analysis_result.get('kekurangan', 'Tidak dapat dianalisis'),
-                                "Risk Factor": analysis_result.get('risk_factor', 'Tidak dapat dianalisis'),
-                                "Reward Factor": analysis_result.get('reward_factor', 'Tidak dapat dianalisis'),
-                                "Overall Fit": analysis_result.get('overall_fit', 0),
-                                "Justifikasi": analysis_result.get('justifikasi', 'Tidak dapat dianalisis')
-                            })
-                            processed_count += 1
-                            print(f"Berhasil proses: {filename}")
-                            
-                        except Exception as e:
-                            print(f"Error processing attachment {filename}: {e}")
-                            continue
-                            
-            except Exception as e:
-                print(f"Error processing message {message['id']}: {e}")
-                continue
-
-        message = f"{processed_count} resume baru berhasil diproses, {skipped_count} resume sudah ada sebelumnya dari {len(messages)} email."
-        
-        return JSONResponse(content={
-            "message": message, 
-            "results": processed_results,
-            "processed_count": processed_count,
-            "skipped_count": skipped_count,
-            "total_emails": len(messages),
-            "spreadsheet_name": spreadsheet_name,
-            "gmail_query_used": gmail_query
-        })
+        return JSONResponse(content=await run_screening_now(
+            session.owner, [generate_spreadsheet_name(config['job_position_name'])],
+            functools.partial(execute_screening_run, creds, config)
+        ))
 
     except HTTPException as e:
         raise e
@@ -743,34 +3708,134 @@ async def start_screening(request: Request):
         print(f"Terjadi error tak terduga di start_screening: {e}")
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
 
-@app.get("/api/get-results")
-async def get_results(request: Request):
-    global job_position_name
+@app.post("/api/start-screening-multi")
+async def start_multi_screening(body: MultiScreeningConfig, request: Request):
+    """
+    Screening beberapa posisi sekaligus: mailbox dipindai dan setiap PDF diunduh serta diekstrak
+    sekali, lalu setiap CV dianalisis untuk setiap posisi yang subjek emailnya cocok.
+    """
+    creds, session = get_session(request)
+    configs = multi_position_configs(session, body.job_positions)
     
     try:
-        _, _, gc, _ = get_google_services(request=request)
-        
-        # Jika tidak ada nama posisi yang diset, gunakan spreadsheet default
-        if not job_position_name:
-            spreadsheet_name = "Analisis Resume AI"
-        else:
-            spreadsheet_name = generate_spreadsheet_name(job_position_name)
+        return JSONResponse(content=await run_screening_now(
+            session.owner, [generate_spreadsheet_name(config['job_position_name']) for config in configs],
+            functools.partial(execute_multi_position_run, creds, configs)
+        ))
+
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        print(f"Terjadi error tak terduga di start_multi_screening: {e}")
+        raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
+
+@app.post("/api/jobs", status_code=202)
+async def create_screening_job(request: Request):
+    """
+    Memulai screening sebagai job background dan langsung mengembalikan job_id.
+    Progress dipantau lewat /api/jobs/{job_id} atau stream SSE /api/jobs/{job_id}/events.
+    """
+    creds, session = get_session(request)
+    config = session.snapshot()
+    require_screening_config(config)
+    
+    return launch_screening_job(
+        session.owner, [generate_spreadsheet_name(config['job_position_name'])],
+        functools.partial(execute_screening_run, creds, config)
+    )
+
+@app.post("/api/jobs/multi", status_code=202)
+async def create_multi_screening_job(body: MultiScreeningConfig, request: Request):
+    """Seperti /api/jobs, tetapi untuk beberapa posisi sekaligus (lihat /api/start-screening-multi)."""
+    creds, session = get_session(request)
+    configs = multi_position_configs(session, body.job_positions)
+    
+    return launch_screening_job(
+        session.owner, [generate_spreadsheet_name(config['job_position_name']) for config in configs],
+        functools.partial(execute_multi_position_run, creds, configs)
+    )
+
+@app.get("/api/jobs/{job_id}")
+async def get_job_status(job_id: str, request: Request):
+    """Status, progress, dan hasil sementara sebuah job screening"""
+    return JSONResponse(content=get_screening_job(request, job_id).to_dict())
+
+@app.get("/api/jobs/{job_id}/events")
+async def stream_job_status(job_id: str, request: Request):
+    """Stream progress job (Server-Sent Events); mendukung header Last-Event-ID untuk menyambung ulang."""
+    job = get_screening_job(request, job_id)
+    try:
+        start = int(request.headers.get('last-event-id', -1)) + 1
+    except ValueError:
+        start = 0
+    return StreamingResponse(
+        stream_job_events(job, start),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.get("/api/get-results")
+async def get_results(request: Request, background_tasks: BackgroundTasks,
+                      limit: Optional[int] = Query(None, ge=1, le=RESULTS_MAX_PAGE_SIZE),
+                      cursor: Optional[str] = None,
+                      sort: Optional[Literal['overall_fit', 'waktu']] = None,
+                      order: Optional[Literal['asc', 'desc']] = None,
+                      min_fit: Optional[int] = None,
+                      fields: Optional[str] = None):
+    """
+    Hasil screening dibaca dari mirror SQLite lokal. Jika ID spreadsheet sudah terdaftar dan
+    mirror-nya ada, respons langsung dari mirror tanpa panggilan Google; modifiedTime dicek di
+    background (check_results_mirror, dibatasi RESULTS_CHECK_INTERVAL). Selain itu spreadsheet
+    dicari lewat Drive, dan sheet hanya dibaca langsung saat mirror belum ada.
+
+    Query opsional:
+    - limit / cursor: pagination; `next_cursor` di respons dipakai untuk halaman berikutnya
+    - sort: `overall_fit` atau `waktu` (default urutan baris spreadsheet)
+    - order: `asc` / `desc` (default `desc` jika sort diisi, selain itu `asc`)
+    - min_fit: hanya kandidat dengan Overall Fit >= nilai ini
+    - fields: daftar kolom dipisah koma, mis. `Nama,Email,Overall Fit`
+    Tanpa parameter, seluruh hasil dikembalikan sesuai urutan spreadsheet.
+    """
+    try:
+        creds, session = get_session(request)
+        spreadsheet_name = current_spreadsheet_name(session)
         
-        spreadsheet = ensure_spreadsheet_exists(gc, spreadsheet_name)
-        sheet = spreadsheet.sheet1
+        order = order or ('desc' if sort else 'asc')
+        after = decode_results_cursor(cursor, sort, order) if cursor else None
         
-        # Ambil semua data
-        all_records = sheet.get_all_records()
+        spreadsheet_id = await asyncio.to_thread(lookup_spreadsheet_id, session.owner, spreadsheet_name)
+        synced = spreadsheet_id is not None and (await asyncio.to_thread(load_results_sync, spreadsheet_id))[0]
+        if synced:
+            if should_check_results_mirror(spreadsheet_id):
+                background_tasks.add_task(check_results_mirror, creds, session.owner, spreadsheet_name)
+        else:
+            _, drive, gc, _ = build_google_services(creds)
+            spreadsheet_file = await asyncio.to_thread(
+                find_spreadsheet_file, drive, session.owner, spreadsheet_name
+            )
+            if spreadsheet_file is None:
+                spreadsheet = await asyncio.to_thread(ensure_spreadsheet_exists, gc, spreadsheet_name)
+                spreadsheet_file = {'id': spreadsheet.id, 'modifiedTime': None}
+            spreadsheet_id = spreadsheet_file['id']
+            modified_time = spreadsheet_file.get('modifiedTime')
+            
+            synced, synced_modified_time = await asyncio.to_thread(load_results_sync, spreadsheet_id)
+            if not synced:
+                await asyncio.to_thread(sync_results_mirror, gc, spreadsheet_id, modified_time)
+            elif modified_time is None or modified_time != synced_modified_time:
+                background_tasks.add_task(refresh_results_mirror, gc, spreadsheet_id, modified_time)
         
-        # Hapus kolom CV_Hash dari hasil yang dikembalikan ke frontend
-        filtered_records = []
-        for record in all_records:
-            filtered_record = {k: v for k, v in record.items() if k != 'CV_Hash'}
-            filtered_records.append(filtered_record)
+        records, next_key = await asyncio.to_thread(
+            query_results_mirror, spreadsheet_id, sort, order == 'desc', limit, after, min_fit
+        )
+        if fields:
+            selected = [field.strip() for field in fields.split(',') if field.strip()]
+            records = [{field: record[field] for field in selected if field in record} for record in records]
         
         return JSONResponse(content={
-            "results": filtered_records,
-            "spreadsheet_name": spreadsheet_name
+            "results": records,
+            "spreadsheet_name": spreadsheet_name,
+            "next_cursor": encode_results_cursor(sort, order, next_key) if next_key else None
         })
         
     except HTTPException as e:
@@ -783,16 +3848,11 @@ async def get_results(request: Request):
 
 @app.delete("/api/clear-results")
 async def clear_results(request: Request):
-    global job_position_name
-    
     try:
-        _, _, gc, _ = get_google_services(request=request)
+        creds, session = get_session(request)
+        _, _, gc, _ = build_google_services(creds)
+        spreadsheet_name = current_spreadsheet_name(session)
         
-        if not job_position_name:
-            spreadsheet_name = "Analisis Resume AI"
-        else:
-            spreadsheet_name = generate_spreadsheet_name(job_position_name)
-            
         spreadsheet = ensure_spreadsheet_exists(gc, spreadsheet_name)
         sheet = spreadsheet.sheet1
         
@@ -809,6 +3869,15 @@ async def clear_results(request: Request):
             
             sheet.update(cell_range, empty_values)
         
+        # Data dikosongkan, jadi email lama perlu dipindai ulang pada run berikutnya
+        clear_gmail_cursors(session.owner, spreadsheet_name)
+        clear_attachment_index(session.owner, spreadsheet_name)
+        clear_near_dup_index(session.owner, spreadsheet_name)
+        clear_prefilter_corpus(session.owner, spreadsheet_name)
+        clear_work_items(session.owner, spreadsheet_name)
+        clear_sheet_hashes(spreadsheet.id)
+        clear_results_mirror(spreadsheet.id)
+        
         return JSONResponse(content={
             "message": f"Isi data pada spreadsheet '{spreadsheet_name}' berhasil dikosongkan (header tetap).",
             "spreadsheet_name": spreadsheet_name
@@ -823,12 +3892,18 @@ async def clear_results(request: Request):
 async def list_spreadsheets(request: Request):
     """Menampilkan daftar spreadsheet yang ada"""
     try:
-        _, _, gc, _ = get_google_services(request=request)
+        creds, session = get_session(request)
+        _, _, gc, _ = build_google_services(creds)
         
         # Cari semua spreadsheet yang dimulai dengan "Analisis Resume AI"
         all_spreadsheets = []
         try:
             spreadsheet_list = gc.list_spreadsheet_files()
+            register_spreadsheets(account_key(gc.http_client.auth), {
+                spreadsheet_info['name']: spreadsheet_info['id']
+                for spreadsheet_info in spreadsheet_list
+                if spreadsheet_info.get('name', '').startswith('Analisis Resume AI') and spreadsheet_info.get('id')
+            })
             for spreadsheet_info in spreadsheet_list:
                 name = spreadsheet_info.get('name', '')
                 if name.startswith('Analisis Resume AI'):
@@ -842,7 +3917,7 @@ async def list_spreadsheets(request: Request):
         
         return JSONResponse(content={
             "spreadsheets": all_spreadsheets,
-            "current_spreadsheet": generate_spreadsheet_name(job_position_name) if job_position_name else "Belum diset"
+            "current_spreadsheet": generate_spreadsheet_name(session.job_position_name) if session.job_position_name else "Belum diset"
         })
         
     except Exception as e:
@@ -854,7 +3929,6 @@ def health_check():
     return {
         "status": "ok", 
         "message": "Server is running",
-        "current_job_position": job_position_name or "Belum diset",
-        "email_subjects_count": len(email_subjects),
-        "has_job_description": bool(job_description_text)
+        "active_sessions": len(session_store),
+        "screening_jobs": len(screening_jobs)
     }
\ No newline at end of file